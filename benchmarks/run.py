@@ -0,0 +1,172 @@
+"""Benchmark download_cats fetchers against the local stand-in server
+
+Every mode is a set of download_cats command line arguments. For each mode
+the fetcher of the layout runs in a child process downloading into an empty
+temporary directory, the benchmark records wall time, bytes downloaded,
+throughput, CPU time and maximum RSS of the child and its worker processes.
+
+Example:
+
+    python benchmarks/run.py --layout gaia --files 40 --size-mb 16 --latency 0.05 --bandwidth-mb 20 \\
+        --mode pool-8='-j 8' --mode asyncio-32='--engine asyncio -j 32' --output results.json
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+from time import monotonic
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.server import add_server_arguments, server_from_args  # noqa: E402
+
+
+DEFAULT_MODES = {
+    'pool-1': '-j 1',
+    'pool-8': '-j 8',
+    'asyncio-8': '--engine asyncio -j 8',
+    'asyncio-32': '--engine asyncio -j 32 --per-host 32',
+}
+
+
+def _patch_gaia(fetcher, base_url):
+    fetcher.base_url = urljoin(base_url, 'Gaia/gdr3/gaia_source/')
+    fetcher.checksums_url = urljoin(fetcher.base_url, '_MD5SUM.txt')
+
+
+def _patch_ztf(fetcher, base_url):
+    fetcher.base_url = urljoin(base_url, 'data/ZTF/lc_dr11/')
+    fetcher.checksums_url = urljoin(fetcher.base_url, 'checksum.md5')
+
+
+def _patch_2mass(fetcher, base_url):
+    fetcher.base_url = urljoin(base_url, '2MASS/download/allsky/')
+
+
+def _patch_htm(fetcher, base_url):
+    from download_cats import cats_htm
+
+    cats_htm.BASE_URL = urljoin(base_url, 'catsHTM/')
+
+
+# Layout name: download_cats catalog arguments and function pointing the fetcher to the server
+LAYOUTS = {
+    'gaia': (['gaia', '--dr', 'dr3'], _patch_gaia),
+    'ztf': (['ztf', '--dr', '11'], _patch_ztf),
+    '2mass': (['2mass'], _patch_2mass),
+    'htm': (['htm'], _patch_htm),
+}
+
+
+def run_child(layout, base_url, argv):
+    """Run fetcher in the current process like `python -m download_cats` does"""
+    from download_cats import FETCHERS
+    from download_cats.__main__ import parse_args
+    from download_cats.utils import configure_downloader, configure_logging, get_report
+
+    sys.argv = ['download_cats', *argv]
+    cli_args = parse_args()
+    configure_logging(cli_args)
+    configure_downloader(cli_args)
+    fetcher = FETCHERS[cli_args.catalog](cli_args)
+    LAYOUTS[layout][1](fetcher, base_url)
+    try:
+        fetcher()
+    finally:
+        get_report().write(cli_args.report)
+
+
+def run_mode(layout, base_url, name, mode_args):
+    with tempfile.TemporaryDirectory(prefix='download_cats_bench_') as tmp:
+        report_path = os.path.join(tmp, 'report.json')
+        catalog_args, _ = LAYOUTS[layout]
+        argv = [*shlex.split(mode_args), '-d', os.path.join(tmp, 'data'), '--cache-dir', os.path.join(tmp, 'cache'),
+                '--report', report_path, *catalog_args]
+        start = monotonic()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'child', layout, base_url, '--', *argv])
+        # wait4 gives resource usage of this child including its waited worker processes
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall = monotonic() - start
+        try:
+            with open(report_path) as fh:
+                summary = json.load(fh)['summary']
+        except FileNotFoundError:
+            summary = {'bytes': 0, 'files': {}}
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return {
+        'mode': name,
+        'args': mode_args,
+        'exit_code': process.returncode,
+        'wall_time': wall,
+        'bytes': summary['bytes'],
+        'files': summary['files'],
+        'throughput_mib_s': summary['bytes'] / wall / 2**20,
+        'user_cpu': rusage.ru_utime,
+        'system_cpu': rusage.ru_stime,
+        'cpu_per_gib': cpu / (summary['bytes'] / 2**30) if summary['bytes'] else None,
+        # Linux reports it in KiB
+        'max_rss_mib': rusage.ru_maxrss / 1024,
+    }
+
+
+def parse_mode(s):
+    name, sep, args = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f'mode must be specified as NAME=ARGS, not "{s}"')
+    return name, args
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark download_cats against a local stand-in server')
+    add_server_arguments(parser)
+    parser.add_argument('--mode', action='append', type=parse_mode, default=None,
+                        help='benchmark mode as NAME=ARGS where ARGS are download_cats arguments, can be repeated, '
+                             f'default is {" ".join(f"{k}={v!r}" for k, v in DEFAULT_MODES.items())}')
+    parser.add_argument('--repeat', default=1, type=int, help='number of runs of every mode')
+    parser.add_argument('--output', default=None, help='JSON file to write results to')
+    return parser.parse_args()
+
+
+def print_results(results):
+    print(f'{"mode":<16} {"exit":>4} {"wall, s":>8} {"MiB/s":>8} {"CPU, s":>8} {"CPU s/GiB":>9} {"RSS, MiB":>9}')
+    for r in results:
+        cpu_per_gib = '-' if r['cpu_per_gib'] is None else f'{r["cpu_per_gib"]:.2f}'
+        print(f'{r["mode"]:<16} {r["exit_code"]:>4} {r["wall_time"]:>8.2f} {r["throughput_mib_s"]:>8.1f} '
+              f'{r["user_cpu"] + r["system_cpu"]:>8.2f} {cpu_per_gib:>9} {r["max_rss_mib"]:>9.1f}')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'child':
+        _, _, layout, base_url, _, *argv = sys.argv
+        run_child(layout, base_url, argv)
+        return
+
+    args = parse_args()
+    modes = args.mode or list(DEFAULT_MODES.items())
+    server = server_from_args(args)
+    host, port = server.server_address
+    base_url = f'http://{host}:{port}/'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    try:
+        for name, mode_args in modes:
+            for _ in range(args.repeat):
+                results.append(run_mode(args.layout, base_url, name, mode_args))
+    finally:
+        server.shutdown()
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump({'server': {k: v for k, v in vars(args).items() if k not in ('mode', 'output')},
+                       'results': results}, fh, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Local HTTP stand-in for catalogue archives serving synthetic files
+
+File content is a pseudo-random block repeated to the file size, so files of
+any size are served without storing them and any byte range is cheap. Files
+with .gz names repeat a gzip member of the block instead, so they are valid
+multi-member gzip files and their sizes are rounded to the member size. The
+server mimics the layouts of the archives used by download_cats fetchers:
+ESA Gaia (_MD5SUM.txt), IRSA ZTF (checksum.md5 with nested paths), IRSA 2MASS
+(HTML listing) and catsHTM (HTML table of catalogs, wget scripts and checksum
+files).
+
+Run it standalone with `python benchmarks/server.py --layout gaia`, it prints
+its base URL to stdout when it is ready.
+"""
+
+import argparse
+import gzip
+import random
+import threading
+from dataclasses import dataclass
+from email.utils import formatdate
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+
+BLOCK_SIZE = 1 << 16
+WRITE_CHUNK = 1 << 16
+LAST_MODIFIED = formatdate(1_600_000_000, usegmt=True)
+# Names known by catsHTM.script.get_CatDir
+CATSHTM_CATALOGS = ('TMASS', 'PS1', 'APASS', 'NVSS', 'FIRST', 'UCAC4', 'WISE')
+LAYOUTS = ('gaia', 'ztf', '2mass', 'htm')
+
+
+@dataclass
+class SyntheticFile:
+    size: int
+    block: bytes
+
+    @classmethod
+    def from_seed(cls, seed, size, gzipped=False):
+        block = random.Random(seed).randbytes(BLOCK_SIZE)
+        if gzipped:
+            block = gzip.compress(block, mtime=0)
+            # File must end at the end of a member
+            size = max(1, round(size / len(block))) * len(block)
+        return cls(size=size, block=block)
+
+    def chunks(self, start, end):
+        """Yield file content from start to end inclusive"""
+        block_size = len(self.block)
+        pos = start
+        while pos <= end:
+            offset = pos % block_size
+            n = min(block_size - offset, end + 1 - pos, WRITE_CHUNK)
+            yield memoryview(self.block)[offset:offset + n]
+            pos += n
+
+    def md5(self):
+        m = md5()
+        for chunk in self.chunks(0, self.size - 1):
+            m.update(chunk)
+        return m.hexdigest()
+
+
+def _sizes(rng, n_files, mean_size):
+    return [max(1, int(mean_size * rng.uniform(0.25, 1.75))) for _ in range(n_files)]
+
+
+def _checksums(files):
+    return ''.join(f'{f.md5()}  {name}\n' for name, f in files.items())
+
+
+def build_tree(layout, n_files, mean_size, seed=0):
+    """Mapping of URL path to `SyntheticFile` or str content"""
+    rng = random.Random(seed)
+    sizes = _sizes(rng, n_files, mean_size)
+    tree = {}
+    if layout == 'gaia':
+        prefix = '/Gaia/gdr3/gaia_source/'
+        files = {f'GaiaSource_{i:06d}-{i + 1:06d}.csv.gz': SyntheticFile.from_seed(f'gaia{i}', size, gzipped=True)
+                 for i, size in enumerate(sizes)}
+        tree[f'{prefix}_MD5SUM.txt'] = _checksums(files)
+    elif layout == 'ztf':
+        prefix = '/data/ZTF/lc_dr11/'
+        files = {f'{i // 100}/field{i:06d}/ztf_{i:06d}_zg_c01_q1_dr11.parquet': SyntheticFile.from_seed(f'ztf{i}', size)
+                 for i, size in enumerate(sizes)}
+        tree[f'{prefix}checksum.md5'] = _checksums(files)
+    elif layout == '2mass':
+        prefix = '/2MASS/download/allsky/'
+        files = {f'psc_{i:03d}.gz': SyntheticFile.from_seed(f'2mass{i}', size, gzipped=True)
+                 for i, size in enumerate(sizes)}
+        rows = ''.join(f'<tr><td><a href="{name}">{name}</a></td><td>{f.size}</td></tr>\n' for name, f in files.items())
+        tree[prefix] = f'<html><body><table>\n{rows}</table></body></html>\n'
+    elif layout == 'htm':
+        prefix = '/catsHTM/'
+        files = {}
+        rows = []
+        for i, size in enumerate(sizes):
+            name = CATSHTM_CATALOGS[i % len(CATSHTM_CATALOGS)]
+            files[f'data/{name}/{name}_htm_{i:06d}.hdf5'] = SyntheticFile.from_seed(f'htm{i}', size)
+        for name in CATSHTM_CATALOGS:
+            catalog_files = {path: f for path, f in files.items() if path.startswith(f'data/{name}/')}
+            if not catalog_files:
+                continue
+            tree[f'{prefix}wget_{name}.sh'] = ''.join(f'wget -c http://HOST{prefix}{path}\n' for path in catalog_files)
+            tree[f'{prefix}checksum_{name}.md5'] = ''.join(f'{f.md5()}  {path.rsplit("/", 1)[-1]}\n'
+                                                           for path, f in catalog_files.items())
+            rows.append(f'<tr><td>{name}</td><td>wget_{name}.sh</td><td>checksum_{name}.md5</td></tr>')
+        table = '\n'.join(rows)
+        tree[f'{prefix}catsHTM_catalogs.html'] = (
+            '<html><body><table>\n<tr><th>Name</th><th>wget file</th><th>checksum</th></tr>\n'
+            f'{table}\n</table></body></html>\n'
+        )
+    else:
+        raise ValueError(f'Unknown layout {layout}')
+    tree.update({f'{prefix}{name}': f for name, f in files.items()})
+    return tree
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Set by make_server
+    tree = {}
+    latency = 0.0
+    bandwidth = None
+    ranges = True
+    fail_rate = 0.0
+    truncate_rate = 0.0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _serve(self, send_body):
+        if self.latency > 0:
+            sleep(self.latency)
+        path = self.path.split('?', 1)[0]
+        content = self.tree.get(path)
+        if content is None:
+            self._send_empty(404)
+            return
+        if isinstance(content, str):
+            body = content.replace('http://HOST', f'http://{self.headers["Host"]}').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html' if path.endswith(('/', '.html')) else 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+        if send_body and self._random() < self.fail_rate:
+            self._send_empty(503)
+            return
+        self._serve_file(content, send_body)
+
+    def _serve_file(self, f, send_body):
+        start, end = 0, f.size - 1
+        range_header = self.headers.get('Range')
+        if self.ranges and range_header is not None and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first)
+            if start >= f.size:
+                self._send_empty(416)
+                return
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{f.size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+        truncate_at = None
+        if self._random() < self.truncate_rate:
+            truncate_at = start + int((end - start) * self._random())
+        sent = 0
+        t0 = monotonic()
+        for chunk in f.chunks(start, end):
+            if truncate_at is not None and start + sent + len(chunk) > truncate_at:
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.bandwidth is not None and (ahead := sent / self.bandwidth - (monotonic() - t0)) > 0:
+                sleep(ahead)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+
+def make_server(tree, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, ranges=True, fail_rate=0.0,
+                truncate_rate=0.0, seed=0):
+    """Create ThreadingHTTPServer, bandwidth is per connection in bytes per second"""
+    handler = type('ConfiguredHandler', (Handler,), dict(
+        tree=tree,
+        latency=latency,
+        bandwidth=bandwidth,
+        ranges=ranges,
+        fail_rate=fail_rate,
+        truncate_rate=truncate_rate,
+        rng=random.Random(seed),
+        rng_lock=threading.Lock(),
+    ))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--layout', default='gaia', choices=LAYOUTS, help='archive layout to mimic')
+    parser.add_argument('--files', default=20, type=int, help='number of data files')
+    parser.add_argument('--size-mb', default=4.0, type=float, help='mean data file size in MiB')
+    parser.add_argument('--latency', default=0.0, type=float, help='delay before every response in seconds')
+    parser.add_argument('--bandwidth-mb', default=None, type=float,
+                        help='bandwidth cap of a single connection in MiB/s')
+    parser.add_argument('--no-range', action='store_true', help='ignore Range headers')
+    parser.add_argument('--fail-rate', default=0.0, type=float,
+                        help='probability of 503 response to a data file request')
+    parser.add_argument('--truncate-rate', default=0.0, type=float,
+                        help='probability of closing connection in the middle of a data file')
+    parser.add_argument('--seed', default=0, type=int, help='random seed for file content, sizes and failures')
+
+
+def server_from_args(args, port=0):
+    tree = build_tree(args.layout, args.files, int(args.size_mb * 2**20), seed=args.seed)
+    bandwidth = None if args.bandwidth_mb is None else args.bandwidth_mb * 2**20
+    return make_server(tree, port=port, latency=args.latency, bandwidth=bandwidth, ranges=not args.no_range,
+                       fail_rate=args.fail_rate, truncate_rate=args.truncate_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser('Local HTTP stand-in for catalogue archives')
+    add_server_arguments(parser)
+    parser.add_argument('--port', default=0, type=int, help='port to listen, zero means any free port')
+    args = parser.parse_args()
+    server = server_from_args(args, port=args.port)
+    host, port = server.server_address
+    print(f'http://{host}:{port}/', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,81 @@
 import argparse
+import logging
+import sys
 
 from download_cats import FETCHERS
-from download_cats.utils import configure_logging
+from download_cats.utils import (DEFAULT_CACHE_DIR, DEFAULT_DOWNLOAD_CHUNK, DEFAULT_RETRY_DELAY, DEFAULT_RETRY_ROUNDS,
+                                 DEFAULT_SEGMENT_THRESHOLD, DownloadFailed, configure_downloader, configure_logging,
+                                 get_report, parse_shard, throughput_history)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser('Download astronomical catalogues')
     parser.add_argument('-d', '--dir', default='.', help='destination directory')
-    parser.add_argument('-j', '--jobs', default=1, type=int, help='number of parallel job to run')
+    parser.add_argument('--stripe-dir', action='append', default=[], metavar='DIR',
+                        help='additional destination directory, e.g. on another filesystem, can be repeated, files are '
+                             'spread over --dir and these directories by free space and write throughput keeping '
+                             'their relative paths, placement is recorded in --dir for put_cat_to_ch')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='number of parallel job to run, for "asyncio" engine it is number of concurrent transfers')
+    parser.add_argument('--engine', default='pool', choices=('pool', 'asyncio'),
+                        help='download engine: "pool" runs a process per job, "asyncio" runs all transfers in a '
+                             'single process')
+    parser.add_argument('--per-host', default=16, type=int,
+                        help='maximum number of concurrent transfers from a single host, used by "asyncio" engine')
+    parser.add_argument('--concurrency', default='adaptive', choices=('adaptive', 'fixed'),
+                        help='"adaptive" starts with a few transfers per host and adds more while throughput grows, '
+                             'backing off when server is overloaded, "fixed" always uses --per-host, '
+                             'used by "asyncio" engine')
+    parser.add_argument('--rate', default=None, type=float,
+                        help='maximum number of requests per second to a single host, used by "asyncio" engine')
+    parser.add_argument('--mirror', action='append', default=[], metavar='URL',
+                        help='alternative base URL serving catalog files with the same layout, can be repeated, files '
+                             'are downloaded from the fastest of the original URL and mirrors, failing mirrors are '
+                             'avoided')
+    parser.add_argument('--chunk-size', default=DEFAULT_DOWNLOAD_CHUNK >> 20, type=int,
+                        help='download buffer size in MiB')
+    parser.add_argument('--segments', default=1, type=int,
+                        help='number of parallel connections to download a single large file')
+    parser.add_argument('--segment-threshold', default=DEFAULT_SEGMENT_THRESHOLD >> 20, type=int,
+                        help='minimum file size in MiB to download it in segments')
+    parser.add_argument('--shard', default=None, type=parse_shard, metavar='I/N',
+                        help='download only I-th of N parts of the file list, I is from 0 to N-1, parts are balanced '
+                             'by file size when it is known, e.g. --shard=$SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT '
+                             'for a job array submitted with --array=0-(N-1)')
+    parser.add_argument('--sync', action='store_true',
+                        help='download only files which checksums are added or changed since the last run and report '
+                             'files removed upstream, files without checksums are always downloaded')
+    parser.add_argument('--plan', action='store_true',
+                        help='do not download anything, print number of files and bytes to download, free disk space '
+                             'and estimated time based on throughput of previous runs')
+    parser.add_argument('--order', default='listing', choices=('listing', 'largest'),
+                        help='order of downloads: "listing" keeps the order of the catalog file list and starts '
+                             'downloading while it is being listed, "largest" lists all files first and starts from '
+                             'the largest ones using sizes recorded by previous runs')
+    parser.add_argument('--probe-sizes', action='store_true',
+                        help='for --order=largest, get unknown file sizes with HEAD requests')
+    parser.add_argument('--check-gzip', action='store_true',
+                        help='validate .gz files without checksums by decompressing them while downloading, '
+                             'corrupted files are downloaded again')
+    parser.add_argument('--rehash', action='store_true',
+                        help='compute md5 of existing files even if it is recorded in the checksum manifest')
+    parser.add_argument('--verify-size', action='store_true',
+                        help='for files without checksums, skip existing files which have the same size as remote ones '
+                             'and are not older than them, it is checked with HEAD requests')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='directory to cache file listings and checksum files')
+    parser.add_argument('--cache-max-age', default=0.0, type=float,
+                        help='time in seconds to use cached file listings without checking if they are modified')
+    parser.add_argument('--no-cache', action='store_true', help='do not cache file listings and checksum files')
+    parser.add_argument('--retry-rounds', default=DEFAULT_RETRY_ROUNDS, type=int,
+                        help='number of times a failed file is put back to the queue to be downloaded again later, '
+                             'other files are downloaded meanwhile')
+    parser.add_argument('--retry-delay', default=DEFAULT_RETRY_DELAY, type=float,
+                        help='base delay in seconds before a failed file is downloaded again, it is doubled every '
+                             'round and randomized')
+    parser.add_argument('--report', default=None,
+                        help='write per-file download statistics to this file, CSV if it has .csv extension, '
+                             'JSON otherwise')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='logging verbosity')
 
     subparsers = parser.add_subparsers(
@@ -20,16 +88,32 @@ def parse_args():
     for name, fetcher in FETCHERS.items():
         fetcher_parser = subparsers.add_parser(name)
         fetcher.add_arguments_to_parser(fetcher_parser)
+        # Catalog-specific options select what is listed, --sync keeps a record per their values
+        options = argparse.ArgumentParser(add_help=False)
+        fetcher.add_arguments_to_parser(options)
+        fetcher_parser.set_defaults(catalog_options=tuple(vars(options.parse_args([]))))
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
 def main():
     cli_args = parse_args()
     configure_logging(cli_args)
+    configure_downloader(cli_args)
     fetcher = FETCHERS[cli_args.catalog](cli_args)
-    fetcher()
+    try:
+        fetcher()
+    except DownloadFailed as e:
+        logging.error(str(e))
+        sys.exit(1)
+    finally:
+        report = get_report()
+        report.log_summary()
+        if cli_args.report is not None:
+            report.write(cli_args.report)
+        if not cli_args.no_cache:
+            throughput_history(cli_args).add(cli_args.catalog, report.summary(), cli_args.jobs)
 
 
 if __name__ == "__main__":
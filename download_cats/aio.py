@@ -0,0 +1,540 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from download_cats.stats import FileStats
+from download_cats.utils import (DeferredRetries, FileDownloader, GzipCheckFailed, HashSumCheckFailed,
+                                  RangeRequestFailed, is_file_downloaded, unexpected_failure)
+
+
+# Responses meaning that server is overloaded
+CONGESTION_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class HostLimiter:
+    """Token bucket rate limiter and AIMD concurrency controller for a single host
+
+    Concurrency limit starts from `initial`. Every `window` seconds received
+    throughput is compared with the previous window: limit is increased by one
+    while throughput grows. It is halved when server responds with 429 or 5xx
+    status, the connection times out or is reset, 429 and 503 responses with
+    Retry-After header also pause all new requests to the host. Failures of
+    transfers started before the last decrease don't decrease it again, so a
+    burst of concurrent failures halves the limit once.
+
+    Arguments
+    ---------
+    max_concurrency : int
+        Upper bound for number of concurrent transfers
+    rate : float or None
+        Maximum number of requests per second, None means no limit
+    adaptive : bool
+        If False, concurrency is always `max_concurrency`
+    initial : int or None
+        Initial concurrency limit for adaptive mode, default is
+        min(`max_concurrency`, 4)
+    window : float
+        Throughput measurement interval, seconds
+    growth_threshold : float
+        Relative throughput increase to consider it growing
+    """
+
+    def __init__(self, max_concurrency, rate=None, adaptive=True, initial=None, window=5.0, growth_threshold=0.05):
+        assert max_concurrency > 0
+        self.max_concurrency = max_concurrency
+        self.adaptive = adaptive
+        if not self.adaptive:
+            self.limit = float(max_concurrency)
+        elif initial is None:
+            self.limit = float(min(max_concurrency, 4))
+        else:
+            self.limit = float(min(max_concurrency, initial))
+        self.rate = rate
+        self.burst = max(1.0, rate or 0.0)
+        self.tokens = self.burst
+        self.window = window
+        self.growth_threshold = growth_threshold
+        self.active = 0
+        self.condition = asyncio.Condition()
+        loop_time = asyncio.get_running_loop().time()
+        self.tokens_updated = loop_time
+        self.paused_until = loop_time
+        self.window_start = loop_time
+        self.window_bytes = 0
+        self.prev_throughput = None
+        self.decreased_at = None
+
+    @property
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    async def _take_token(self):
+        while True:
+            now = self._now
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.rate is None:
+                return
+            self.tokens = min(self.burst, self.tokens + (now - self.tokens_updated) * self.rate)
+            self.tokens_updated = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        """Wait for a free transfer slot and a request token, returns the transfer start time for `release`"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        await self._take_token()
+        return self._now
+
+    async def release(self, exception=None, started=None):
+        """Free transfer slot taken by `acquire`
+
+        `exception` is the one the transfer failed with, `started` is the
+        time returned by `acquire`
+        """
+        if exception is not None and self._is_congestion(exception):
+            self._pause(exception)
+            # Transfers started before the last decrease saw the old limit, don't count them again
+            stale = started is not None and self.decreased_at is not None and started < self.decreased_at
+            if self.adaptive and not stale:
+                self.limit = max(1.0, self.limit / 2)
+                self.decreased_at = self._now
+                logging.info(f'Server is congested ({exception!r}), concurrency limit is decreased to {int(self.limit)}')
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @staticmethod
+    def _is_congestion(exception):
+        if isinstance(exception, aiohttp.ClientResponseError):
+            return exception.status in CONGESTION_STATUSES
+        return isinstance(exception, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+    def _pause(self, exception):
+        headers = getattr(exception, 'headers', None) or {}
+        retry_after = headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            logging.info(f'Server asked to retry after {retry_after} seconds')
+            self.paused_until = max(self.paused_until, self._now + int(retry_after))
+
+    def received(self, n):
+        """Account n received bytes and update concurrency limit when window is over"""
+        self.window_bytes += n
+        if not self.adaptive:
+            return
+        now = self._now
+        if now - self.window_start < self.window:
+            return
+        throughput = self.window_bytes / (now - self.window_start)
+        self.window_start = now
+        self.window_bytes = 0
+        # Grow only if the limit is reached, otherwise more slots wouldn't help
+        saturated = self.active >= int(self.limit)
+        if (self.prev_throughput is None or throughput > self.prev_throughput * (1.0 + self.growth_threshold)) \
+                and saturated and self.limit < self.max_concurrency:
+            self.limit += 1.0
+            asyncio.get_running_loop().create_task(self._notify_waiters())
+            logging.info(f'Throughput is {throughput:.3g} B/s, concurrency limit is increased to {int(self.limit)}')
+        self.prev_throughput = throughput
+
+    async def _notify_waiters(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+
+class _BatchWriter:
+    """Thread writing received data, pieces queued while it is busy are joined into a single write
+
+    Data is handed over as soon as it is received, so a broken transfer
+    keeps everything received before it broke
+
+    Arguments
+    ---------
+    write : callable
+        Function writing bytes, it is called in the thread
+    batch_size : int
+        Maximum size of a joined write, larger pieces are written as is
+    depth : int
+        Maximum number of pieces waiting to be written
+    """
+
+    def __init__(self, write, batch_size, depth=64):
+        self.write = write
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=depth)
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        closed = False
+        while not closed:
+            if (data := self.queue.get()) is None:
+                return
+            batch = [data]
+            size = len(data)
+            while size < self.batch_size:
+                try:
+                    data = self.queue.get_nowait()
+                except Empty:
+                    break
+                if data is None:
+                    closed = True
+                    break
+                batch.append(data)
+                size += len(data)
+            # Keep draining the queue after a failure, so put doesn't block
+            if self.error is None:
+                try:
+                    self.write(batch[0] if len(batch) == 1 else b''.join(batch))
+                except BaseException as e:
+                    self.error = e
+
+    async def put(self, data):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait(data)
+        except Full:
+            await asyncio.to_thread(self.queue.put, data)
+
+    async def close(self):
+        """Wait until all data is written, raise the exception writing failed with"""
+        await asyncio.to_thread(self.queue.put, None)
+        await asyncio.to_thread(self.thread.join)
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncFileDownloader(FileDownloader):
+    """Asynchronous version of `FileDownloader`
+
+    Arguments
+    ---------
+    url : str
+        URL to download
+    path : str
+        Destination file path
+    session : aiohttp.ClientSession
+        Client session to use, it is required here
+    checksum : str or None
+        Hex representation of md5 checksum, if None no checksum validation
+        performed
+    resume : bool
+        Continue download of existing partial file
+    limiter : HostLimiter or None
+        Limiter of the URL host, every download attempt waits for it
+    """
+
+    def __init__(self, url, path, session, checksum=None, retries=1, resume=True, limiter=None):
+        super().__init__(url, path, checksum=checksum, session=session, retries=retries, resume=resume)
+        self.limiter = limiter
+
+    def _received(self, chunk):
+        if self.limiter is not None:
+            self.limiter.received(len(chunk))
+
+    async def download(self):
+        logging.info(f'Downloading {self.url} to {self.path}')
+        self._create_dir()
+        record = self._load_segment_record()
+        # Partial file of a segmented download has holes, so its size is not the resume offset
+        offset = 0 if record is not None else self._resume_offset()
+        start = perf_counter()
+        self.resp = await self.session.get(self.url, headers=self._range_headers(offset))
+        self.stats.ttfb = perf_counter() - start
+        if self.resp.status == 416:
+            logging.info(f'Partial file {self.partial_path} is not valid for {self.url}, downloading whole file')
+            self.resp.close()
+            offset = 0
+            self.resp = await self.session.get(self.url)
+        self.resp.raise_for_status()
+        offset = self._response_offset(self.resp.status, self.resp.headers, offset)
+        size = self._segmented_size(offset, self.resp.headers, resuming=record is not None)
+        record = self._resumable_segment_record(record, size)
+        if size is not None:
+            await self._download_segments(size, record)
+        else:
+            # Resumed partial file is hashed, don't block other transfers
+            await asyncio.to_thread(self._open, offset)
+            await self._copy_body()
+        self._finish()
+
+    async def _copy_body(self):
+        # Write and hash in a thread while the next data is being received
+        writer = _BatchWriter(self.write, self.chunk_size)
+        try:
+            async for data in self.resp.content.iter_any():
+                self._received(data)
+                await writer.put(data)
+        finally:
+            await writer.close()
+
+    async def _fetch_segment(self, start, end, resp=None):
+        if resp is None:
+            resp = await self.session.get(self.url, headers={'Range': f'bytes={start}-{end}'})
+            resp.raise_for_status()
+            self._check_segment_response(resp.status, resp.headers, start)
+        pos = start
+
+        def write(chunk):
+            nonlocal pos
+            new_pos = self._write_segment_chunk(chunk, pos, end)
+            save = self._segment_progress(start, new_pos, new_pos - pos)
+            pos = new_pos
+            if save:
+                self._save_segment_record()
+
+        writer = _BatchWriter(write, self.chunk_size)
+        received = start
+        try:
+            async for data in resp.content.iter_any():
+                self._received(data)
+                await writer.put(data)
+                received += len(data)
+                if received > end:
+                    break
+        finally:
+            try:
+                await writer.close()
+            finally:
+                resp.close()
+        self._check_segment_complete(pos, end)
+
+    async def _download_segments(self, size, record=None):
+        # Preallocation can take a while on some filesystems
+        bounds = await asyncio.to_thread(self._start_segments, size, record)
+        logging.info(f'Downloading {self.url} in {len(bounds)} segments')
+        # Response to the first request is reused if it is needed
+        first_resp = self.resp if bounds and bounds[0][0] == 0 else None
+        tasks = [asyncio.create_task(self._fetch_segment(start, end, first_resp if start == 0 else None))
+                 for start, end in bounds]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Keep downloaded ranges to resume the download later
+            await asyncio.to_thread(self._save_segment_record)
+            self.stats.bytes += sum(pos - start for start, pos in self.segment_record['progress'].items())
+        await asyncio.to_thread(self._hash_partial)
+
+    async def __aenter__(self):
+        attempts = self._attempts()
+        for attempt in range(attempts):
+            started = None
+            if self.limiter is not None:
+                started = await self.limiter.acquire()
+            exception = None
+            self.stats.attempts += 1
+            start = perf_counter()
+            try:
+                await self.download()
+                self.stats.status = 'downloaded'
+                return
+            except (HashSumCheckFailed, RangeRequestFailed, GzipCheckFailed) as e:
+                exception = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                exception = e
+            finally:
+                self.stats.transfer_time += perf_counter() - start
+                self._close()
+                if self.limiter is not None:
+                    await self.limiter.release(exception, started)
+            content_error = isinstance(exception, (HashSumCheckFailed, RangeRequestFailed, GzipCheckFailed))
+            if not content_error and attempt + 1 < attempts:
+                await asyncio.sleep(self._backoff_delay(attempt))
+        self._failed(exception)
+        raise exception
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._close()
+
+
+async def download_file_async(url, path, session, checksum=None, retries=1, limiter=None, raise_on_failure=True):
+    """Asynchronous version of `download_file_stats`
+
+    `limiter` is `HostLimiter` of the URL host or None
+
+    Returns
+    -------
+    FileStats
+    """
+    start = perf_counter()
+    # md5 of an existing file would block the event loop for too long
+    if await asyncio.to_thread(is_file_downloaded, path, checksum):
+        return FileStats(url=url, path=path, status='skipped', size=os.path.getsize(path),
+                         hash_time=perf_counter() - start)
+    downloader = AsyncFileDownloader(url, path, session, checksum=checksum, retries=retries, limiter=limiter)
+    try:
+        async with downloader:
+            return downloader.stats
+    except (HashSumCheckFailed, RangeRequestFailed, GzipCheckFailed, aiohttp.ClientError, asyncio.TimeoutError):
+        if raise_on_failure:
+            raise
+        return downloader.stats
+
+
+class AsyncDownloadEngine:
+    """Download many files concurrently from a single process
+
+    Arguments
+    ---------
+    connections : int
+        Maximum number of transfers in flight
+    per_host : int
+        Maximum number of concurrent transfers from a single host
+    retries : int
+        Number of download attempts for each file
+    rate : float or None
+        Maximum number of requests per second to a single host
+    adaptive : bool
+        Adjust number of concurrent transfers from each host to its
+        throughput, see `HostLimiter`
+    report : DownloadReport or None
+        Report to add statistics of every file to
+    deferred : DeferredRetries or None
+        Queue of failed files to download again later, if None failed files
+        are not retried
+    router : MirrorRouter or None
+        Router choosing a mirror for every download
+    """
+
+    def __init__(self, connections, per_host, retries=1, rate=None, adaptive=True, report=None, deferred=None,
+                 router=None):
+        assert connections > 0
+        assert per_host > 0
+        self.connections = connections
+        self.per_host = per_host
+        self.retries = retries
+        self.rate = rate
+        self.adaptive = adaptive
+        self.report = report
+        self.deferred = DeferredRetries(rounds=0) if deferred is None else deferred
+        self.router = router
+        self.retrying = set()
+        self.limiters = defaultdict(lambda: HostLimiter(self.per_host, rate=self.rate, adaptive=self.adaptive))
+
+    async def _worker(self, queue, session):
+        while True:
+            task = await queue.get()
+            # Deferred task is done when it is put back to the queue
+            done = True
+            try:
+                # Routing probes mirrors with blocking requests the first time
+                fetch_task, source = (task, None) if self.router is None else \
+                    await asyncio.to_thread(self.router.route, task)
+                url, path, *checksum = fetch_task
+                limiter = self.limiters[urlsplit(url).netloc]
+                try:
+                    stats = await download_file_async(url, path, session, *checksum, retries=self.retries,
+                                                      limiter=limiter, raise_on_failure=False)
+                except Exception as e:
+                    stats = unexpected_failure(fetch_task, e)
+                if self.router is not None:
+                    self.router.record(source, task, stats)
+                if self.deferred.defer(task, stats):
+                    done = False
+                    retry = asyncio.create_task(self._retry_later(queue))
+                    self.retrying.add(retry)
+                    retry.add_done_callback(self.retrying.discard)
+                elif self.report is not None:
+                    self.report.add(stats)
+            finally:
+                if done:
+                    queue.task_done()
+
+    async def _retry_later(self, queue):
+        """Put the next deferred task back to the queue when it is ready"""
+        try:
+            while (task := self.deferred.pop_ready()) is None:
+                await asyncio.sleep(self.deferred.time_to_next())
+            await queue.put(task)
+        finally:
+            queue.task_done()
+
+    async def run(self, tasks):
+        # Bounded queue keeps memory footprint constant for arbitrary long task lists
+        queue = asyncio.Queue(maxsize=2 * self.connections)
+        connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.create_task(self._worker(queue, session)) for _ in range(self.connections)]
+            try:
+                # Tasks can be listed lazily with blocking requests, don't stall transfers in flight
+                tasks = iter(tasks)
+                while (task := await asyncio.to_thread(next, tasks, None)) is not None:
+                    await self._put(queue, task, workers)
+                await self._join(queue, workers)
+            finally:
+                retrying = list(self.retrying)
+                for task in [*workers, *retrying]:
+                    task.cancel()
+                await asyncio.gather(*workers, *retrying, return_exceptions=True)
+
+    @staticmethod
+    async def _put(queue, task, workers):
+        put = asyncio.create_task(queue.put(task))
+        await asyncio.wait([put, *workers], return_when=asyncio.FIRST_COMPLETED)
+        AsyncDownloadEngine._raise_failed(workers)
+        await put
+
+    @staticmethod
+    async def _join(queue, workers):
+        join = asyncio.create_task(queue.join())
+        await asyncio.wait([join, *workers], return_when=asyncio.FIRST_COMPLETED)
+        AsyncDownloadEngine._raise_failed(workers)
+
+    @staticmethod
+    def _raise_failed(workers):
+        """Propagate the first exception raised by any worker"""
+        for worker in workers:
+            if worker.done():
+                worker.result()
+
+
+def download_files_async(tasks, connections, per_host, retries=1, rate=None, adaptive=True, report=None,
+                         deferred=None, router=None):
+    """Download files with `AsyncDownloadEngine`
+
+    Arguments
+    ---------
+    tasks : iterable of tuples
+        `(url, path)` or `(url, path, checksum)` tuples
+    connections : int
+        Maximum number of transfers in flight
+    per_host : int
+        Maximum number of concurrent transfers from a single host
+    rate : float or None
+        Maximum number of requests per second to a single host
+    adaptive : bool
+        Adjust number of concurrent transfers from each host to its throughput
+    report : DownloadReport or None
+        Report to add statistics of every file to
+    deferred : DeferredRetries or None
+        Queue of failed files to download again later
+    router : MirrorRouter or None
+        Router choosing a mirror for every download
+    """
+    engine = AsyncDownloadEngine(connections, per_host, retries=retries, rate=rate, adaptive=adaptive,
+                                 report=report, deferred=deferred, router=router)
+    asyncio.run(engine.run(tasks))
+
+
+__all__ = ('HostLimiter', 'AsyncFileDownloader', 'AsyncDownloadEngine', 'download_file_async',
+           'download_files_async',)
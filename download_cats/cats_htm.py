@@ -26,8 +26,8 @@ def get_catalog_list(dest):
     url = urljoin(BASE_URL, HTML_TABLE_NAME)
     logging.info('Downloading catalog HTML table')
     try:
-        table = ascii.read(url, format='html')
-    except ConnectionError as e:
+        table = ascii.read(url_text_content(url, base_url=BASE_URL), format='html')
+    except (ConnectionError, requests.exceptions.ConnectionError) as e:
         path_local = os.path.join(dest, HTML_TABLE_NAME)
         logging.warning(f'URL {url} is not available, trying to use local file {path_local}')
         table = ascii.read(path_local, format='html')
@@ -38,23 +38,25 @@ def get_catalog_list(dest):
     return table
 
 
-def download_catalog(name, dest, wget_url, checksum_url):
-    logging.info(f'Downloading {name}')
+def parse_wget_script(s):
+    """Extract filename-URL pairs from wget script content"""
+    urls = (line.split()[-1] for line in s.splitlines())
+    return {os.path.basename(url): url for url in urls}
 
-    os.makedirs(dest, exist_ok=True)
-    session = requests.Session()
 
-    wget_script = url_text_content(wget_url, session)
-    urls = (line.split()[-1] for line in wget_script.splitlines())
-    urls = {os.path.basename(url): url for url in urls}
+def catalog_tasks(name, dest, wget_url, checksum_url):
+    """Download tasks for all files of a catalog, see `download_files`"""
+    logging.info(f'Listing {name} files')
 
-    checksums = parse_checksums(url_text_content(checksum_url, session))
+    session = get_session()
+
+    urls = url_parsed_content(wget_url, parse_wget_script, session, base_url=BASE_URL)
+    checksums = url_parsed_content(checksum_url, parse_checksums, session, base_url=BASE_URL)
 
     assert set(urls) == set(checksums)
 
     for filename, url in urls.items():
-        path = os.path.join(dest, filename)
-        download_file(url, path, checksum=checksums[filename], session=session, retries=3)
+        yield url, os.path.join(dest, filename), checksums[filename]
 
 
 class CatsHTMFetcher(BaseFetcher):
@@ -74,12 +76,12 @@ class CatsHTMFetcher(BaseFetcher):
         table = get_catalog_list(self.dest)
         args = table[['Name', 'dest', 'wget_url', 'checksum_url']]
 
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(
-                download_catalog,
-                (x for x in args.iterrows() if x[0].lower() in self.catalogs),
-                chunksize=1,
-            )
+        # Files of all catalogs share a single queue, so a few large catalogs don't keep other jobs idle
+        download_files(
+            self.cli_args,
+            (task for x in args.iterrows() if x[0].lower() in self.catalogs for task in catalog_tasks(*x)),
+            base_url=BASE_URL,
+        )
 
     @staticmethod
     def add_arguments_to_parser(parser):
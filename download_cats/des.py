@@ -22,9 +22,7 @@ class DesFetcher(BaseFetcher):
         self.dr = cli_args.dr
         self.base_url = f'https://desdr-server.ncsa.illinois.edu/despublic/dr{self.dr}_tiles/'
 
-    def _get_urls_filenames(self):
-        logging.info(f'Getting index of DES DR{self.dr} tiles')
-        html = url_text_content(self.base_url)
+    def _parse_index(self, html):
         bs = BeautifulSoup(html)
         urls = []
         filenames = []
@@ -41,13 +39,16 @@ class DesFetcher(BaseFetcher):
             filenames.append(filename)
         return urls, filenames
 
+    def _get_urls_filenames(self):
+        logging.info(f'Getting index of DES DR{self.dr} tiles')
+        return url_parsed_content(self.base_url, self._parse_index, base_url=self.base_url)
+
     def __call__(self):
         logging.info(f'Fetching DES DR{self.dr} main table')
         urls, filenames = self._get_urls_filenames()
         assert len(urls) > 0
         paths = [os.path.join(self.dest, fname) for fname in filenames]
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(download_file, zip(urls, paths), chunksize=1)
+        download_files(self.cli_args, zip(urls, paths), base_url=self.base_url)
 
     @staticmethod
     def add_arguments_to_parser(parser):
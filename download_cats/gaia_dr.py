@@ -20,16 +20,15 @@ class GaiaDrLcFetcher(BaseFetcher):
         self.base_url = f'http://cdn.gea.esac.esa.int/Gaia/g{self.dr}/gaia_source/'
         self.checksums_url = urljoin(self.base_url, '_MD5SUM.txt')
 
+    def tasks(self):
+        """Download tasks of data files, see `download_files`"""
+        checksums = url_parsed_content(self.checksums_url, parse_checksums, base_url=self.base_url)
+        return [(urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
+                for fname, checksum in checksums.items() if fname.endswith('.csv.gz')]
+
     def __call__(self):
         logging.info(f'Fetching Gaia {self.dr.upper()} light curve data')
-        checksums = parse_checksums(url_text_content(self.checksums_url))
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(
-                download_file,
-                ((urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
-                 for fname, checksum in checksums.items() if fname.endswith('.csv.gz')),
-                chunksize=1
-            )
+        download_files(self.cli_args, self.tasks(), base_url=self.base_url)
 
     @staticmethod
     def add_arguments_to_parser(parser):
@@ -18,9 +18,7 @@ class GalexFetcher(BaseFetcher):
         self.base_url = 'http://dolomiti.pha.jhu.edu/uvsky/GUVcat/GUVcat_AIS_FOV055/2019/5deglatslices/'
         self.content_list_url = 'http://dolomiti.pha.jhu.edu/uvsky/GUVcat/GUVcat_AIS.html'
 
-    def _get_urls_filenames(self):
-        logging.info(f'Getting index of GALEX catalogs of unique UV sources')
-        html = url_text_content(self.content_list_url)
+    def _parse_index(self, html):
         bs = BeautifulSoup(html)
         urls = []
         filenames = []
@@ -37,12 +35,15 @@ class GalexFetcher(BaseFetcher):
             filenames.append(filename)
         return urls, filenames
 
+    def _get_urls_filenames(self):
+        logging.info(f'Getting index of GALEX catalogs of unique UV sources')
+        return url_parsed_content(self.content_list_url, self._parse_index)
+
     def __call__(self):
         logging.info(f'Fetching GALEX catalogs of unique UV sources')
         urls, filenames = self._get_urls_filenames()
         paths = [os.path.join(self.dest, fname) for fname in filenames]
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(download_file, zip(urls, paths), chunksize=1)
+        download_files(self.cli_args, zip(urls, paths), base_url=self.base_url)
 
     @staticmethod
     def add_arguments_to_parser(parser):
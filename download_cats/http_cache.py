@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from time import time
+
+from download_cats.manifest import read_json_lines
+
+
+def _digest(s):
+    return sha256(s.encode()).hexdigest()
+
+
+def _parser_key(parse):
+    # Bump cache_version attribute of a parser when its output changes
+    return f'{parse.__module__}.{parse.__qualname__}:{getattr(parse, "cache_version", 0)}'
+
+
+class HttpCache:
+    """On-disk cache of small HTTP responses like file listings and checksums
+
+    Each cached response is revalidated with a conditional request using its
+    ETag and Last-Modified headers, unless it was fetched less than `max_age`
+    seconds ago. Parsed representations of the responses are cached too and
+    they are reused while the response body, the parser with its
+    `cache_version` attribute and the cache `version` are the same. All files
+    are written atomically, so the cache directory can be shared by many
+    processes and nodes.
+
+    Arguments
+    ---------
+    directory : str
+        Cache directory, it is created if it doesn't exist
+    max_age : float
+        Time in seconds to use cached response without revalidation
+    """
+
+    # Version of the parsed results format, bump it to invalidate all of them
+    version = 1
+
+    def __init__(self, directory, max_age=0.0):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url, suffix):
+        return os.path.join(self.directory, f'{_digest(url)[:32]}.{suffix}')
+
+    def _write_atomic(self, path, s):
+        with NamedTemporaryFile('w', encoding='utf-8', dir=self.directory, delete=False) as fh:
+            fh.write(s)
+        os.replace(fh.name, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _read_body(self, url):
+        try:
+            with open(self._path(url, 'body'), encoding='utf-8') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, url, meta, body=None):
+        if body is not None:
+            self._write_atomic(self._path(url, 'body'), body)
+        self._write_atomic(self._path(url, 'meta.json'), json.dumps(meta))
+
+    def _fetch(self, url, session, need_body=True):
+        """Returns body digest and body, the body is None if it is not needed and response is not modified"""
+        meta = self._read_json(self._path(url, 'meta.json'))
+        body = None
+        if meta is not None and need_body:
+            body = self._read_body(url)
+            if body is None:
+                meta = None
+        if meta is not None and time() - meta['fetched'] < self.max_age:
+            logging.info(f'Using cached {url}')
+            return meta['digest'], body
+
+        headers = {}
+        if meta is not None:
+            if meta['etag'] is not None:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified'] is not None:
+                headers['If-Modified-Since'] = meta['last_modified']
+        resp = session.get(url, headers=headers)
+        if resp.status_code == 304 and meta is not None:
+            logging.info(f'Cached {url} is not modified')
+            meta['fetched'] = time()
+            self._store(url, meta)
+            return meta['digest'], body
+        resp.raise_for_status()
+
+        body = resp.text
+        meta = {
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'fetched': time(),
+            'digest': _digest(body),
+        }
+        self._store(url, meta, body)
+        return meta['digest'], body
+
+    def text(self, url, session):
+        """String representation of URL content"""
+        _, body = self._fetch(url, session)
+        return body
+
+    def parsed(self, url, parse, session):
+        """Result of parse(text) for URL content
+
+        The result must be JSON-serializable, tuples are returned as lists
+        """
+        path = self._path(url, f'{_digest(f"{self.version}:{_parser_key(parse)}")[:16]}.parsed.json')
+        parsed = self._read_json(path)
+        digest, body = self._fetch(url, session, need_body=parsed is None)
+        if parsed is not None and parsed['digest'] == digest:
+            return parsed['value']
+        if body is None:
+            body = self.text(url, session)
+        value = parse(body)
+        self._write_atomic(path, json.dumps({'digest': digest, 'value': value}))
+        return value
+
+
+class SizeCache:
+    """On-disk record of remote file sizes
+
+    Sizes are appended to a JSON lines file in the cache directory, the last
+    record of a URL wins. Only changed sizes are appended, so the file grows
+    with the number of files, not with the number of runs.
+
+    Arguments
+    ---------
+    directory : str
+        Cache directory, it is created if it doesn't exist
+    """
+
+    filename = 'sizes.jsonl'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.filename)
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = None
+
+    @property
+    def sizes(self):
+        if self._sizes is None:
+            self._sizes = {record['url']: record['size'] for record in read_json_lines(self.path) or ()}
+        return self._sizes
+
+    def get(self, url):
+        return self.sizes.get(url)
+
+    def update(self, sizes):
+        """Record sizes given as url-size mapping"""
+        lines = []
+        for url, size in sizes.items():
+            if self.sizes.get(url) == size:
+                continue
+            self.sizes[url] = size
+            lines.append(json.dumps({'url': url, 'size': size}) + '\n')
+        if lines:
+            with open(self.path, 'a') as fh:
+                fh.write(''.join(lines))
+
+
+__all__ = ('HttpCache', 'SizeCache',)
@@ -0,0 +1,31 @@
+import json
+from typing import List, Optional
+
+
+# Sidecar files written by download_cats to the destination directory
+CHECKSUM_MANIFEST = '.download_cats_md5.jsonl'
+PLACEMENT_MANIFEST = '.download_cats_placement.jsonl'
+INVENTORY = '.download_cats_inventory.jsonl'
+
+
+def read_json_lines(path: str) -> Optional[List[dict]]:
+    """Records of JSON lines file skipping truncated lines, None if the file doesn't exist
+
+    Records are appended by single writes, but the last line can still be
+    truncated if a process was killed while writing it
+    """
+    try:
+        with open(path) as fh:
+            lines = fh.readlines()
+    except FileNotFoundError:
+        return None
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+__all__ = ('CHECKSUM_MANIFEST', 'PLACEMENT_MANIFEST', 'INVENTORY', 'read_json_lines',)
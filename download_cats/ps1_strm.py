@@ -1,5 +1,6 @@
 import logging
 import os
+from itertools import chain
 from urllib.parse import urljoin
 
 from download_cats.base import BaseFetcher
@@ -16,20 +17,24 @@ class Ps1StrmFetcher(BaseFetcher):
         self.base_url = f'https://archive.stsci.edu/hlsps/ps1-strm/'
         self.checksums_url = urljoin(self.base_url, 'hlsp_ps1-strm_ps1_gpc1_all_multi_v1_md5sum.txt')
 
+    def tasks(self):
+        """Download tasks of data files, see `download_files`"""
+        checksums = url_parsed_content(self.checksums_url, parse_checksums, base_url=self.base_url)
+        return [(urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
+                for fname, checksum in checksums.items() if fname.endswith('.csv.gz')]
+
     def __call__(self):
         logging.info(f'Fetching PS1 STRM data')
-        # download readme
         readme_filename = 'hlsp_ps1-strm_ps1_gpc1_all_multi_v1_readme.txt'
-        download_file(urljoin(self.base_url, readme_filename), os.path.join(self.dest, readme_filename))
-        # download data
-        checksums = parse_checksums(url_text_content(self.checksums_url))
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(
-                download_file,
-                ((urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
-                 for fname, checksum in checksums.items() if fname.endswith('.csv.gz')),
-                chunksize=1
-            )
+        # download readme together with data
+        download_files(
+            self.cli_args,
+            chain(
+                [(urljoin(self.base_url, readme_filename), os.path.join(self.dest, readme_filename))],
+                self.tasks(),
+            ),
+            base_url=self.base_url,
+        )
 
     @staticmethod
     def add_arguments_to_parser(parser):
@@ -0,0 +1,172 @@
+import csv
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, fields
+from time import monotonic, time
+
+
+@dataclass
+class FileStats:
+    """Download statistics of a single file
+
+    Times are in seconds. `transfer_time` is wall time of all download attempts
+    including writing, it overlaps with `hash_time` which is time spent to
+    compute md5 and validate gzip data, either while downloading or to check
+    an existing file.
+    `size` is the size of the complete file, `bytes` is the number of bytes
+    transferred by this run. `mirror` is the base URL the file is downloaded
+    from if it is not the original one, see `MirrorRouter`.
+    """
+    url: str
+    path: str
+    status: str = 'pending'
+    size: int = None
+    bytes: int = 0
+    ttfb: float = None
+    transfer_time: float = 0.0
+    hash_time: float = 0.0
+    attempts: int = 0
+    error: str = None
+    mirror: str = None
+
+    @property
+    def throughput(self):
+        """Bytes per second, None if nothing is transferred"""
+        if self.transfer_time == 0.0:
+            return None
+        return self.bytes / self.transfer_time
+
+
+class DownloadReport:
+    """Aggregate of `FileStats` for a whole run
+
+    It logs overall throughput every `log_interval` seconds while files are
+    being added
+
+    Arguments
+    ---------
+    log_interval : float
+        Minimum time between two throughput log records, seconds
+    """
+
+    def __init__(self, log_interval=10.0):
+        self.log_interval = log_interval
+        self.files = []
+        self.start = monotonic()
+        self.last_log = self.start
+        self.last_log_bytes = 0
+        self.bytes = 0
+
+    def add(self, stats):
+        self.files.append(stats)
+        self.bytes += stats.bytes
+        now = monotonic()
+        if now - self.last_log >= self.log_interval:
+            current = (self.bytes - self.last_log_bytes) / (now - self.last_log)
+            logging.warning(f'{self._progress()}, current throughput is {current / 2**20:.1f} MiB/s')
+            self.last_log = now
+            self.last_log_bytes = self.bytes
+
+    def _progress(self):
+        counts = self.counts()
+        elapsed = monotonic() - self.start
+        return (f'{counts.get("downloaded", 0)} files downloaded, {counts.get("skipped", 0)} skipped, '
+                f'{counts.get("failed", 0)} failed, {self.bytes / 2**30:.2f} GiB in {elapsed:.0f} s, '
+                f'average throughput is {self.bytes / elapsed / 2**20:.1f} MiB/s')
+
+    def counts(self):
+        """Number of files by status"""
+        counts = {}
+        for stats in self.files:
+            counts[stats.status] = counts.get(stats.status, 0) + 1
+        return counts
+
+    def summary(self):
+        transferred = [stats for stats in self.files if stats.bytes > 0]
+        ttfbs = sorted(stats.ttfb for stats in self.files if stats.ttfb is not None)
+        return {
+            'elapsed': monotonic() - self.start,
+            'files': self.counts(),
+            'bytes': self.bytes,
+            'transfer_time': sum(stats.transfer_time for stats in transferred),
+            'hash_time': sum(stats.hash_time for stats in self.files),
+            'retries': sum(max(stats.attempts - 1, 0) for stats in self.files),
+            'median_ttfb': ttfbs[len(ttfbs) // 2] if ttfbs else None,
+        }
+
+    def log_summary(self):
+        if self.files:
+            logging.warning(f'Finished: {self._progress()}')
+
+    def log_failures(self):
+        """Log all failed files as a single record"""
+        failed = [stats for stats in self.files if stats.status == 'failed']
+        if failed:
+            lines = '\n'.join(f'  {stats.url}: {stats.error}' for stats in failed)
+            logging.error(f'{len(failed)} files failed to download:\n{lines}')
+
+    def write(self, path):
+        """Write report as CSV if path ends with .csv, otherwise as JSON"""
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as fh:
+                writer = csv.DictWriter(fh, fieldnames=[field.name for field in fields(FileStats)])
+                writer.writeheader()
+                writer.writerows(asdict(stats) for stats in self.files)
+            return
+        with open(path, 'w') as fh:
+            json.dump({'summary': self.summary(), 'files': [asdict(stats) for stats in self.files]}, fh, indent=1)
+
+
+class ThroughputHistory:
+    """Throughput of previous runs recorded as JSON lines
+
+    Arguments
+    ---------
+    path : str
+        Path of the history file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, catalog, summary, jobs):
+        """Record run summary, see `DownloadReport.summary`, runs which downloaded nothing are ignored"""
+        if summary['bytes'] == 0:
+            return
+        record = {'time': time(), 'catalog': catalog, 'jobs': jobs, 'bytes': summary['bytes'],
+                  'elapsed': summary['elapsed']}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(record) + '\n')
+
+    def recent(self, catalog, n=5):
+        """Mean throughput in bytes per second of the last n runs for catalog, None if there are no such runs"""
+        try:
+            with open(self.path) as fh:
+                records = [json.loads(line) for line in fh if line.strip()]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        records = [record for record in records if record['catalog'] == catalog][-n:]
+        if not records:
+            return None
+        return sum(record['bytes'] for record in records) / sum(record['elapsed'] for record in records)
+
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(n) < 1024 or unit == 'TiB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days > 0:
+        return f'{days}d {hours}h {minutes}m'
+    return f'{hours}h {minutes}m {seconds}s'
+
+
+__all__ = ('FileStats', 'DownloadReport', 'ThroughputHistory', 'format_bytes', 'format_duration',)
@@ -17,8 +17,8 @@ class TwoMASS(BaseFetcher):
         super().__init__(cli_args)
         self.dest = cli_args.dir
 
-    def _get_filenames(self):
-        html = url_text_content(self.base_url)
+    @staticmethod
+    def _parse_index(html):
         bs = BeautifulSoup(html)
         filenames = []
         for a in bs.find_all('a'):
@@ -28,15 +28,16 @@ class TwoMASS(BaseFetcher):
             filenames.append(href)
         return filenames
 
+    def _get_filenames(self):
+        return url_parsed_content(self.base_url, self._parse_index, base_url=self.base_url)
+
+    def tasks(self):
+        """Download tasks of data files, see `download_files`"""
+        return [(urljoin(self.base_url, fname), os.path.join(self.dest, fname)) for fname in self._get_filenames()]
+
     def __call__(self):
         logging.info(f'Fetching 2MASS data')
-        filenames = self._get_filenames()
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(
-                download_file,
-                ((urljoin(self.base_url, fname), os.path.join(self.dest, fname)) for fname in filenames),
-                chunksize=1
-            )
+        download_files(self.cli_args, self.tasks(), base_url=self.base_url)
 
     @staticmethod
     def add_arguments_to_parser(parser):
@@ -1,20 +1,88 @@
+import argparse
+import heapq
+import json
 import logging
 import os
+import random
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 from hashlib import md5
+from itertools import chain
 from multiprocessing import Pool
-from time import sleep
+from multiprocessing.pool import ThreadPool
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, sleep
 
 import requests
+import urllib3
 
+from download_cats.http_cache import HttpCache, SizeCache
+from download_cats.manifest import CHECKSUM_MANIFEST, INVENTORY, PLACEMENT_MANIFEST, read_json_lines
+from download_cats.stats import DownloadReport, FileStats, ThroughputHistory, format_bytes, format_duration
 
-DEFAULT_READ_CHUNK = 1 << 14
-DEFAULT_DOWNLOAD_CHUNK = 1 << 14
+
+DEFAULT_READ_CHUNK = 1 << 20
+DEFAULT_DOWNLOAD_CHUNK = 1 << 22
+DEFAULT_PIPELINE_DEPTH = 4
+DEFAULT_SEGMENT_THRESHOLD = 1 << 28
+DEFAULT_SEGMENT_RECORD_INTERVAL = 1 << 28
+DEFAULT_HEAD_THREADS = 32
+DEFAULT_RETRY_ROUNDS = 3
+DEFAULT_RETRY_DELAY = 10.0
+DEFAULT_WRITE_PROBE_SIZE = 1 << 26
+DEFAULT_FREE_SPACE_RESERVE = 1 << 30
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'download_cats')
 
 
 class HashSumCheckFailed(RuntimeError):
     pass
 
 
+class RangeRequestFailed(RuntimeError):
+    pass
+
+
+class GzipCheckFailed(RuntimeError):
+    pass
+
+
+class DownloadFailed(RuntimeError):
+    pass
+
+
+# Exceptions meaning that a download attempt failed, but the next one can succeed,
+# raw response reading raises urllib3 exceptions
+RETRIABLE_ERRORS = (HashSumCheckFailed, RangeRequestFailed, GzipCheckFailed, requests.exceptions.RequestException,
+                    urllib3.exceptions.HTTPError)
+
+
+def backoff_delay(attempt, base, max_delay):
+    """Exponential backoff with full jitter: random delay up to base * 2**attempt, but not larger than max_delay"""
+    return random.uniform(0.0, min(max_delay, base * 2 ** attempt))
+
+
+def http_date_to_timestamp(s):
+    """Convert HTTP date like Last-Modified header value to POSIX timestamp, None if it cannot be parsed"""
+    if s is None:
+        return None
+    try:
+        return parsedate_to_datetime(s).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _update_md5(m, fh, chunk_size=DEFAULT_READ_CHUNK):
+    """Feed the rest of opened binary file to md5 object"""
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        m.update(chunk)
+
+
 def hash_file(path, chunk_size=DEFAULT_READ_CHUNK):
     """Returns hex md5 checksum of file"""
     if not os.path.exists(path):
@@ -23,17 +91,501 @@ def hash_file(path, chunk_size=DEFAULT_READ_CHUNK):
     logging.info(f'Computing md5 for {path}')
     with open(path, 'rb') as fh:
         m = md5()
-        while True:
-            chunk = fh.read(chunk_size)
-            if not chunk:
-                break
-            m.update(chunk)
+        _update_md5(m, fh, chunk_size)
     return m.digest().hex()
 
 
+class GzipValidator:
+    """Streaming validation of gzip data
+
+    Data is decompressed chunk by chunk and thrown away, zlib checks CRC32 and
+    ISIZE of every gzip member. Multi-member files are supported, trailing
+    data after the last member is considered as corruption.
+
+    Arguments
+    ---------
+    max_length : int
+        Maximum size of decompressed buffer
+    """
+
+    def __init__(self, max_length=DEFAULT_READ_CHUNK):
+        self.max_length = max_length
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.members = 0
+        # True if the current member has started but not finished yet
+        self.pending = False
+
+    def update(self, data):
+        try:
+            while data:
+                self.pending = True
+                self.decompressor.decompress(data, self.max_length)
+                if self.decompressor.eof:
+                    self.members += 1
+                    self.pending = False
+                    data = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    data = self.decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise GzipCheckFailed(f'Corrupted gzip data: {e}') from e
+
+    def finish(self):
+        """Check that data ends at the end of a gzip member"""
+        if self.members == 0 or self.pending:
+            raise GzipCheckFailed('Gzip data is truncated')
+
+
+class ChecksumManifest:
+    """md5 checksums of verified files
+
+    Records are stored as JSON lines in `filename` sidecar file located in the
+    same directory as the files. A record is valid while file size and
+    modification time are the same as at the moment the record was made.
+    Records are appended, so the manifest can be updated by multiple
+    processes, the last record for a file wins.
+
+    Attributes
+    ----------
+    filename : str
+        Name of the manifest file
+    rehash : bool
+        Ignore all records, so checksums of existing files are always computed
+    """
+
+    filename = CHECKSUM_MANIFEST
+    rehash = False
+
+    # Directory path -> {filename: record}, records loaded by this process
+    _records = {}
+
+    @classmethod
+    def _manifest_path(cls, dirpath):
+        return os.path.join(dirpath, cls.filename)
+
+    @classmethod
+    def _load(cls, dirpath):
+        return {record['name']: record for record in read_json_lines(cls._manifest_path(dirpath)) or ()}
+
+    @classmethod
+    def _dir_records(cls, dirpath):
+        try:
+            return cls._records[dirpath]
+        except KeyError:
+            records = cls._records[dirpath] = cls._load(dirpath)
+            return records
+
+    @classmethod
+    def checksum(cls, path):
+        """Recorded hex md5 checksum or None if file is changed or not recorded"""
+        if cls.rehash:
+            return None
+        dirpath, name = os.path.split(os.path.abspath(path))
+        record = cls._dir_records(dirpath).get(name)
+        if record is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+            logging.info(f'File {path} is changed since its md5 was recorded')
+            return None
+        return record['md5']
+
+    @classmethod
+    def add(cls, path, checksum):
+        """Record checksum of a verified file"""
+        dirpath, name = os.path.split(os.path.abspath(path))
+        stat = os.stat(path)
+        record = {'name': name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': checksum}
+        # Single write call of a short line in append mode doesn't interleave with other writers
+        with open(cls._manifest_path(dirpath), 'a') as fh:
+            fh.write(json.dumps(record) + '\n')
+        cls._dir_records(dirpath)[name] = record
+
+
+class SyncRecord:
+    """Checksums of the files listed by the last run, used by --sync
+
+    Record is a JSON object of URL-checksum pairs saved in the destination
+    directory, there is a separate record for every catalog, shard and
+    listing scope: catalog-specific options like catsHTM catalogs or data
+    release, and the base URL. Files without checksums are not recorded and
+    they are never considered as unchanged.
+
+    Arguments
+    ---------
+    path : str
+        Path of the record file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_run(cls, cli_args, base_url=None):
+        name = f'.download_cats_sync.{cli_args.catalog}'
+        if cli_args.shard is not None:
+            index, count = cli_args.shard
+            name = f'{name}.{index}-{count}'
+        scope = {'base_url': base_url}
+        for option in getattr(cli_args, 'catalog_options', ()):
+            value = getattr(cli_args, option)
+            # Same set of catsHTM catalogs in another order is the same listing
+            scope[option] = sorted(value) if isinstance(value, list) else value
+        digest = md5(json.dumps(scope, sort_keys=True, default=str).encode()).hexdigest()[:12]
+        return cls(os.path.join(cli_args.dir, f'{name}.{digest}.json'))
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, checksums):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(checksums, fh)
+        os.replace(tmp_path, self.path)
+
+    def changed(self, tasks, report_removed=True):
+        """Tasks for files added or changed since the record was saved
+
+        Files present in the record but not in tasks are logged as removed
+        upstream if `report_removed` is True
+        """
+        previous = self.load()
+        if not previous:
+            logging.warning(f'No previous listing is recorded in {self.path}, all files are synced')
+        changed = []
+        n_added = 0
+        for task in tasks:
+            url, _, *checksum = task
+            checksum = checksum[0] if checksum else None
+            if checksum is None or previous.get(url) != checksum:
+                changed.append(task)
+                n_added += url not in previous
+        logging.warning(f'Sync: {n_added} files are added, {len(changed) - n_added} are changed, '
+                        f'{len(tasks) - len(changed)} are not changed')
+        if report_removed:
+            urls = {task[0] for task in tasks}
+            if removed := [url for url in previous if url not in urls]:
+                lines = '\n'.join(f'  {url}' for url in removed)
+                logging.warning(f'Sync: {len(removed)} files are removed upstream, local copies are kept:\n{lines}')
+        return changed
+
+
+class StripePlacement:
+    """Placement of downloaded files across several destination roots, used by --stripe-dir
+
+    File paths are relative to the primary root which is the destination
+    directory, a file placed to another root has the same relative path
+    there. Placement of files put to other roots is appended as JSON lines
+    to the manifest in the primary root, put_cat_to_ch reads it to find the
+    files.
+
+    A file keeps its root if it is recorded in the manifest or if it, or its
+    partial download, already exists in some root. Other files go to the
+    root which would finish writing its projected load first, that is
+    assigned bytes divided by write throughput measured with a short
+    synchronous write. A root is not used for a file if its free space minus
+    already assigned bytes is less than the file size plus `reserve`.
+
+    Arguments
+    ---------
+    primary : str
+        Primary root, the destination directory
+    roots : list of str
+        Other roots
+    probe_size : int
+        Number of bytes written to measure write throughput of a root
+    reserve : int
+        Free space in bytes to keep in every root
+    """
+
+    manifest_name = PLACEMENT_MANIFEST
+
+    def __init__(self, primary, roots, probe_size=DEFAULT_WRITE_PROBE_SIZE, reserve=DEFAULT_FREE_SPACE_RESERVE):
+        self.primary = os.path.abspath(primary)
+        self.roots = [self.primary]
+        for root in map(os.path.abspath, roots):
+            if root not in self.roots:
+                self.roots.append(root)
+        self.reserve = reserve
+        self.manifest_path = os.path.join(self.primary, self.manifest_name)
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+        self.free = {root: shutil.disk_usage(root).free for root in self.roots}
+        self.throughput = {root: self.write_throughput(root, probe_size) for root in self.roots}
+        self.load = {root: 0 for root in self.roots}
+        for root in self.roots:
+            logging.info(f'Stripe root {root}: {format_bytes(self.free[root])} free, '
+                         f'write throughput is {format_bytes(self.throughput[root])}/s')
+
+    @staticmethod
+    def write_throughput(root, size=DEFAULT_WRITE_PROBE_SIZE, chunk_size=DEFAULT_READ_CHUNK):
+        """Bytes per second of a synchronous write of `size` bytes to a temporary file in `root`"""
+        chunk = os.urandom(chunk_size)
+        n_chunks = max(size // chunk_size, 1)
+        path = os.path.join(root, f'.download_cats_write_probe.{os.getpid()}')
+        start = monotonic()
+        try:
+            with open(path, 'wb') as fh:
+                for _ in range(n_chunks):
+                    fh.write(chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+        finally:
+            os.remove(path)
+        return n_chunks * chunk_size / max(monotonic() - start, 1e-6)
+
+    @classmethod
+    def load_manifest(cls, primary):
+        """Relative path-root mapping of files placed to other roots than `primary`, the last record wins"""
+        return {record['path']: record['root']
+                for record in read_json_lines(os.path.join(primary, cls.manifest_name)) or ()}
+
+    def _existing_root(self, relpath):
+        for root in self.roots:
+            path = os.path.join(root, relpath)
+            if os.path.exists(path) or os.path.exists(f'{path}{FileDownloader.partial_suffix}'):
+                return root
+        return None
+
+    @staticmethod
+    def _pending_bytes(root, relpath, size):
+        """Bytes of the file still to be written to root"""
+        path = os.path.join(root, relpath)
+        try:
+            written = os.path.getsize(path)
+        except FileNotFoundError:
+            written = partial_bytes(path)
+        return max(size - written, 0)
+
+    def _choose_root(self, size):
+        fit = [root for root in self.roots if self.free[root] - self.load[root] - size >= self.reserve]
+        if not fit:
+            root = max(self.roots, key=lambda root: self.free[root] - self.load[root])
+            logging.warning(f'No destination root has {format_bytes(size + self.reserve)} free, using {root}')
+            return root
+        return min(fit, key=lambda root: (self.load[root] + size) / self.throughput[root])
+
+    def place(self, tasks, sizes):
+        """Tasks with paths moved to the chosen roots
+
+        Arguments
+        ---------
+        tasks : list of tuples
+            Download tasks, see `download_files`, tasks with paths outside
+            of the primary root are not moved
+        sizes : list of int or None
+            Expected file sizes, unknown sizes are taken as the mean known
+            size
+        """
+        recorded = self.load_manifest(self.primary)
+        known = [size for size in sizes if size is not None]
+        mean = sum(known) / len(known) if known else 0
+        placed = []
+        new_records = []
+        for task, size in zip(tasks, sizes):
+            url, path, *rest = task
+            relpath = os.path.relpath(os.path.abspath(path), self.primary)
+            if relpath.startswith(os.pardir):
+                placed.append(task)
+                continue
+            size = mean if size is None else size
+            root = recorded.get(relpath)
+            if root not in self.roots:
+                root = self._existing_root(relpath) or self._choose_root(size)
+            # Existing and partially downloaded files already take their space
+            self.load[root] += self._pending_bytes(root, relpath, size)
+            if recorded.get(relpath, self.primary) != root:
+                new_records.append(json.dumps({'path': relpath, 'root': root}) + '\n')
+            placed.append((url, os.path.join(root, relpath), *rest))
+        if new_records:
+            # Single append write, so concurrent shards don't interleave their records
+            with open(self.manifest_path, 'a') as fh:
+                fh.write(''.join(new_records))
+        for root in self.roots:
+            logging.warning(f'Stripe root {root}: {format_bytes(self.load[root])} assigned')
+        return placed
+
+
+def count_rows(path):
+    """Number of table rows of FITS and Parquet files read from their metadata, None for other files"""
+    try:
+        if path.endswith(('.fits', '.fits.gz', '.fit', '.fit.gz')):
+            from astropy.io import fits
+
+            return fits.getheader(path, 1)['NAXIS2']
+        if path.endswith('.parquet'):
+            # pyarrow is not a dependency of download_cats
+            import pyarrow.parquet
+
+            return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    except ImportError:
+        return None
+    except (OSError, IndexError, KeyError, ValueError) as e:
+        logging.info(f'Cannot count rows of {path}: {e}')
+    return None
+
+
+class Inventory:
+    """Files of a destination directory with their sizes, checksums and row counts
+
+    Records are JSON lines with path relative to the directory, root
+    directory if the file is put to another one by --stripe-dir, size, md5
+    checksum if it is known from the catalog listing and number of rows if
+    it can be read from the file metadata, see `count_rows`. Records are
+    appended, only new and changed ones, the last record of a path wins, so
+    the inventory can be updated by multiple processes. put_cat_to_ch reads
+    it instead of scanning the directory.
+
+    Arguments
+    ---------
+    directory : str
+        Destination directory
+    """
+
+    filename = INVENTORY
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, self.filename)
+        self._records = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = {record['path']: record for record in read_json_lines(self.path) or ()}
+        return self._records
+
+    def _record(self, relpath, root, checksum, stats):
+        path = os.path.join(root, relpath)
+        if stats is not None and stats.size is not None:
+            size = stats.size
+        else:
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                return None
+        record = {'path': relpath}
+        if root != self.directory:
+            record['root'] = root
+        record.update(size=size, md5=checksum)
+        previous = self.records.get(relpath)
+        unchanged = (previous is not None and previous.get('root') == record.get('root')
+                     and previous['size'] == size and previous['md5'] == checksum)
+        # Downloaded file can have the same size and no checksum, but different content
+        if unchanged and (stats is None or stats.status == 'skipped'):
+            record['rows'] = previous['rows']
+        else:
+            record['rows'] = count_rows(path)
+        return record
+
+    def update(self, tasks, stats, threads=DEFAULT_HEAD_THREADS):
+        """Record existing files of tasks
+
+        Arguments
+        ---------
+        tasks : list of tuples
+            Download tasks, see `download_files`, paths must be in the
+            destination directory, files placed by --stripe-dir are found
+            using `StripePlacement` manifest
+        stats : list of FileStats
+            Statistics of the files processed by this run, files not processed
+            are recorded only if they are not in the inventory yet
+        """
+        placement = StripePlacement.load_manifest(self.directory)
+        stats = {os.path.abspath(file_stats.path): file_stats for file_stats in stats}
+        candidates = []
+        for url, path, *checksum in tasks:
+            relpath = os.path.relpath(os.path.abspath(path), self.directory)
+            if relpath.startswith(os.pardir):
+                continue
+            root = placement.get(relpath, self.directory)
+            file_stats = stats.get(os.path.join(root, relpath))
+            if file_stats is None:
+                if relpath in self.records:
+                    continue
+            elif file_stats.status == 'failed':
+                continue
+            candidates.append((relpath, root, checksum[0] if checksum else None, file_stats))
+        if not candidates:
+            return
+        with ThreadPool(processes=threads) as pool:
+            records = pool.starmap(self._record, candidates)
+        lines = []
+        for record in records:
+            if record is None or self.records.get(record['path']) == record:
+                continue
+            self.records[record['path']] = record
+            lines.append(json.dumps(record) + '\n')
+        if lines:
+            # Single append write, so concurrent shards don't interleave their records
+            with open(self.path, 'a') as fh:
+                fh.write(''.join(lines))
+            logging.info(f'{len(lines)} files are recorded to {self.path}')
+
+
+def merge_ranges(ranges):
+    """Sorted list of disjoint half-open [start, stop) ranges covering the given ones"""
+    merged = []
+    for start, stop in sorted(ranges):
+        if start >= stop:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def missing_ranges(done, size):
+    """Half-open ranges of [0, size) not covered by done ranges"""
+    missing = []
+    pos = 0
+    for start, stop in merge_ranges(done):
+        if start > pos:
+            missing.append([pos, start])
+        pos = max(pos, stop)
+    if pos < size:
+        missing.append([pos, size])
+    return missing
+
+
 class FileDownloader:
     """Download URL content and safe to file optionally checking md5
 
+    Data is written to `path` + `partial_suffix` file which is renamed to
+    `path` when download is finished and checksum is validated. If the partial
+    file exists from a previous interrupted run, download continues from its
+    end using HTTP Range request, if server ignores Range header whole file
+    is downloaded again. ETag or Last-Modified of the response the partial
+    file was started with is saved to `path` + `partial_suffix` +
+    `validator_suffix` file and sent as If-Range header, so the whole file is
+    downloaded again if the remote file has changed. A partial file without
+    this validator is resumed only if the file has a checksum.
+
+    Large files can be downloaded in `segments` parallel Range requests, each
+    writing into its own part of the preallocated partial file. md5 is computed
+    over the assembled file then. Byte ranges written so far are recorded to
+    `path` + `partial_suffix` + `segments_suffix` file when a segment fails and
+    every `segment_record_interval` bytes, an interrupted segmented download
+    is resumed by requesting the missing ranges only, unless the remote file
+    has changed.
+
+    Response body is read into `pipeline_depth` reused buffers of `chunk_size`
+    bytes, a separate thread writes them to the file and updates md5, so
+    network I/O overlaps with disk I/O and hashing.
+
+    If `check_gzip` is set, .gz files without checksum are decompressed on
+    the fly the same way to validate their gzip CRC32 and size, see
+    `GzipValidator`. Corrupted file is downloaded again immediately.
+
     Arguments
     ---------
     url : str
@@ -41,29 +593,77 @@ class FileDownloader:
     path : str
         Destination file path
     session : requests.Session or None
-        requests.Session object to use, if None requests module is used instead
+        requests.Session object to use, if None session of the current process
+        is used, see `get_session`
     checksum : str or None
         Hex representation of md5 checksum, if None no checksum validation
         performed
+    resume : bool
+        Continue download of existing partial file
 
     Attributes
     ----------
     chunk_size : int
         Download chunk size
+    pipeline_depth : int
+        Number of buffers shared by the receiving and the writing threads
+    partial_suffix : str
+        Suffix of the file used while download is in progress
+    segments : int
+        Number of parallel connections used to download a single large file,
+        one means no segmentation
+    segment_threshold : int
+        Minimum file size in bytes to download it in segments
+    segments_suffix : str
+        Suffix of the partial file record of downloaded byte ranges
+    validator_suffix : str
+        Suffix of the partial file record of its If-Range validator
+    segment_record_interval : int
+        Number of downloaded bytes between two records of byte ranges
+    backoff_base : float
+        Base delay between attempts in seconds, it grows exponentially with
+        every failed attempt, see `backoff_delay`
+    backoff_max : float
+        Maximum delay between attempts in seconds
+    check_gzip : bool
+        Validate .gz files which have no checksum
+    stats : FileStats
+        Statistics of the download, it is updated by every attempt
     """
 
     chunk_size = DEFAULT_DOWNLOAD_CHUNK
+    pipeline_depth = DEFAULT_PIPELINE_DEPTH
+    partial_suffix = '.part'
+    segments = 1
+    segment_threshold = DEFAULT_SEGMENT_THRESHOLD
+    segments_suffix = '.segments'
+    validator_suffix = '.validator'
+    segment_record_interval = DEFAULT_SEGMENT_RECORD_INTERVAL
+    backoff_base = 1.0
+    backoff_max = 60.0
+    check_gzip = False
 
-    def __init__(self, url, path, checksum=None, session=None, retries=1):
+    def __init__(self, url, path, checksum=None, session=None, retries=1, resume=True):
         self.url = url
         self.path = path
-        self.session = session or requests
+        self.partial_path = f'{self.path}{self.partial_suffix}'
+        self.segments_path = f'{self.partial_path}{self.segments_suffix}'
+        self.validator_path = f'{self.partial_path}{self.validator_suffix}'
+        self.session = session or get_session()
         assert retries > 0
         self.retries = retries
+        self.resume = resume
         self.checksum = checksum
-        if self.checksum is not None:
-            self.md5 = md5()
-            self.write = self._write_and_sum
+        self.fh = None
+        self.resp = None
+        self.segment_record = None
+        self.segment_lock = Lock()
+        self.stats = FileStats(url=url, path=path)
+        self.validate_gzip = self.check_gzip and self.checksum is None and self.path.endswith('.gz')
+        self.gzip = None
+        self.content_checked = self.checksum is not None or self.validate_gzip
+        if self.content_checked:
+            self.write = self._write_and_check
         else:
             self.write = self._write
 
@@ -73,59 +673,1124 @@ class FileDownloader:
         logging.info(f"Creating {dirpath} directory if it doesn't exist")
         os.makedirs(dirpath, exist_ok=True)
 
+    def _partial_size(self):
+        if not self.resume:
+            return 0
+        try:
+            return os.path.getsize(self.partial_path)
+        except FileNotFoundError:
+            return 0
+
+    def _resume_offset(self):
+        """Size of the partial file if it can be resumed, otherwise zero"""
+        offset = self._partial_size()
+        if offset != 0 and self.checksum is None and self._load_validator() is None:
+            logging.info(f'Partial file {self.partial_path} has no validator and {self.url} has no checksum, '
+                         f'downloading whole file')
+            return 0
+        return offset
+
+    def _range_headers(self, offset):
+        if offset == 0:
+            return {}
+        headers = {'Range': f'bytes={offset}-'}
+        if (validator := self._load_validator()) is not None:
+            headers['If-Range'] = validator
+        return headers
+
+    @staticmethod
+    def _if_range_validator(headers):
+        """Strong ETag or Last-Modified, weak ETags cannot be used in If-Range"""
+        etag = headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified')
+
+    def _load_validator(self):
+        try:
+            with open(self.validator_path) as fh:
+                return fh.read() or None
+        except FileNotFoundError:
+            return None
+
+    def _save_validator(self):
+        if (validator := self._if_range_validator(self.resp.headers)) is None:
+            self._remove_validator()
+            return
+        with open(self.validator_path, 'w') as fh:
+            fh.write(validator)
+
+    def _remove_validator(self):
+        try:
+            os.remove(self.validator_path)
+        except FileNotFoundError:
+            pass
+
+    def _response_offset(self, status, headers, offset):
+        """Offset of the response body, zero if server ignored Range header"""
+        if offset == 0:
+            return 0
+        if status != 206:
+            logging.info(f'Server ignored Range request for {self.url}, downloading whole file')
+            return 0
+        content_range = headers.get('Content-Range', '')
+        if not content_range.startswith(f'bytes {offset}-'):
+            msg = f'Unexpected Content-Range "{content_range}" for {self.url}, expected start is {offset}'
+            logging.warning(msg)
+            self._remove_partial()
+            raise RangeRequestFailed(msg)
+        logging.info(f'Resuming {self.url} from byte {offset}')
+        return offset
+
+    def _segmented_size(self, offset, headers, resuming=False):
+        """File size if it should be downloaded in segments, otherwise None"""
+        if offset != 0 or (self.segments <= 1 and not resuming):
+            return None
+        if headers.get('Accept-Ranges') != 'bytes' or 'Content-Encoding' in headers:
+            return None
+        size = int(headers.get('Content-Length', 0))
+        if size < self.segment_threshold and not resuming:
+            return None
+        return size
+
+    def _segment_bounds(self, size):
+        """Inclusive byte ranges of the segments"""
+        step = -(-size // self.segments)
+        return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    def _check_segment_response(self, status, headers, start):
+        content_range = headers.get('Content-Range', '')
+        if status != 206 or not content_range.startswith(f'bytes {start}-'):
+            msg = f'Server returned status {status} and Content-Range "{content_range}" for {self.url} segment'
+            logging.warning(msg)
+            raise RangeRequestFailed(msg)
+
+    @staticmethod
+    def _remote_version(headers):
+        return headers.get('ETag') or headers.get('Last-Modified')
+
+    def _load_segment_record(self):
+        """Record of downloaded byte ranges of the partial file, None if there is no valid one
+
+        Partial file of a segmented download with an unusable record has
+        holes in unknown places, so it is removed together with the record
+        """
+        if not self.resume:
+            return None
+        try:
+            with open(self.segments_path) as fh:
+                record = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            record = None
+        try:
+            if record is not None and os.path.getsize(self.partial_path) == record['size']:
+                return record
+        except (FileNotFoundError, KeyError, TypeError):
+            pass
+        logging.info(f'Segment record {self.segments_path} is not valid, downloading whole file')
+        self._remove_partial()
+        self._remove_segment_record()
+        return None
+
+    def _remove_partial(self):
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+        self._remove_validator()
+
+    def _remove_segment_record(self):
+        try:
+            os.remove(self.segments_path)
+        except FileNotFoundError:
+            pass
+
+    def _start_segments(self, size, record):
+        """Open partial file and return inclusive byte ranges to download"""
+        if record is None:
+            self._preallocate(size)
+            bounds = self._segment_bounds(size)
+            done = []
+        else:
+            self.fh = open(self.partial_path, 'r+b')
+            done = record['done']
+            bounds = [(start, stop - 1) for start, stop in missing_ranges(done, size)]
+            downloaded = sum(stop - start for start, stop in done)
+            logging.info(f'Resuming segmented download of {self.url}, {format_bytes(downloaded)} of '
+                         f'{format_bytes(size)} are downloaded')
+        self.segment_record = {'size': size, 'version': self._remote_version(self.resp.headers), 'done': done,
+                               'progress': {start: start for start, _end in bounds}, 'unsaved': 0}
+        return bounds
+
+    def _segment_progress(self, start, pos, n):
+        """Update position of the segment which starts at `start`, return True if the record should be saved"""
+        record = self.segment_record
+        record['progress'][start] = pos
+        record['unsaved'] += n
+        return record['unsaved'] >= self.segment_record_interval
+
+    def _segment_record_snapshot(self):
+        record = self.segment_record
+        record['unsaved'] = 0
+        done = merge_ranges(record['done'] + [[start, pos] for start, pos in record['progress'].items()])
+        return {'size': record['size'], 'version': record['version'], 'done': done}
+
+    def _write_segment_record(self, snapshot):
+        # Data must be on disk before it is recorded as downloaded
+        os.fdatasync(self.fh.fileno())
+        tmp_path = f'{self.segments_path}.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(snapshot, fh)
+        os.replace(tmp_path, self.segments_path)
+
+    def _save_segment_record(self):
+        with self.segment_lock:
+            self._write_segment_record(self._segment_record_snapshot())
+
+    def _preallocate(self, size):
+        self.fh = open(self.partial_path, 'wb')
+        try:
+            os.posix_fallocate(self.fh.fileno(), 0, size)
+        # Not every OS and file system supports it
+        except (AttributeError, OSError):
+            self.fh.truncate(size)
+
+    def _write_segment_chunk(self, chunk, pos, end):
+        """Write chunk at its position and return position of the next one"""
+        view = memoryview(chunk)[:end + 1 - pos]
+        while view:
+            n = os.pwrite(self.fh.fileno(), view, pos)
+            view = view[n:]
+            pos += n
+        return pos
+
+    def _check_segment_complete(self, pos, end):
+        if pos <= end:
+            msg = f'Segment of {self.url} is truncated at byte {pos}, expected end is {end}'
+            logging.warning(msg)
+            raise RangeRequestFailed(msg)
+
+    def _hash_partial(self):
+        self._reset_checks()
+        if self.content_checked:
+            with open(self.partial_path, 'rb') as fh:
+                self._check_file(fh)
+
+    def _fetch_segment(self, start, end, abort, resp=None):
+        if resp is None:
+            resp = self.session.get(self.url, stream=True, headers={'Range': f'bytes={start}-{end}'})
+            resp.raise_for_status()
+            self._check_segment_response(resp.status_code, resp.headers, start)
+        pos = start
+        with resp:
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                if abort.is_set():
+                    return
+                new_pos = self._write_segment_chunk(chunk, pos, end)
+                if self._segment_progress(start, new_pos, new_pos - pos):
+                    self._save_segment_record()
+                pos = new_pos
+                if pos > end:
+                    break
+        self._check_segment_complete(pos, end)
+
+    def _download_segments(self, size, record=None):
+        bounds = self._start_segments(size, record)
+        logging.info(f'Downloading {self.url} in {len(bounds)} segments')
+        # Response to the first request is reused if it is needed
+        first_resp = self.resp if bounds and bounds[0][0] == 0 else None
+        abort = Event()
+        try:
+            if bounds:
+                with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+                    futures = [executor.submit(self._fetch_segment, start, end, abort,
+                                               first_resp if start == 0 else None)
+                               for start, end in bounds]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    finally:
+                        abort.set()
+        finally:
+            # Keep downloaded ranges to resume the download later
+            self._save_segment_record()
+            self.stats.bytes += sum(pos - start for start, pos in self.segment_record['progress'].items())
+        self._hash_partial()
+
+    def _reset_checks(self):
+        self.md5 = md5()
+        self.gzip = GzipValidator() if self.validate_gzip else None
+
+    def _check_file(self, fh):
+        while chunk := fh.read(DEFAULT_READ_CHUNK):
+            self._check(chunk)
+
+    def _open(self, offset):
+        """Open partial file and restore md5 and gzip validation state from its first offset bytes"""
+        self._reset_checks()
+        if offset == 0:
+            self.fh = open(self.partial_path, 'wb')
+            self._save_validator()
+            return
+        self.fh = open(self.partial_path, 'r+b')
+        if self.content_checked:
+            self._check_file(self.fh)
+        self.fh.seek(offset)
+        self.fh.truncate()
+
+    def _finish(self):
+        """Validate checksum and move partial file to its destination"""
+        self.fh.close()
+        try:
+            self._check_checksum()
+            self._check_gzip()
+        except (HashSumCheckFailed, GzipCheckFailed):
+            self._remove_partial()
+            self._remove_segment_record()
+            raise
+        # Keep modification time of the remote file, so it can be compared with Last-Modified later
+        if (mtime := http_date_to_timestamp(self.resp.headers.get('Last-Modified'))) is not None:
+            os.utime(self.partial_path, (mtime, mtime))
+        os.replace(self.partial_path, self.path)
+        self._remove_segment_record()
+        self._remove_validator()
+        self.stats.size = os.path.getsize(self.path)
+        if self.checksum is not None:
+            ChecksumManifest.add(self.path, self.checksum)
+
+    def _resumable_segment_record(self, record, size):
+        """Segment record if the download can be resumed with it, otherwise remove it and return None"""
+        if record is None:
+            return None
+        if size is None or size != record['size'] or self._remote_version(self.resp.headers) != record['version']:
+            logging.info(f'Segmented partial file {self.partial_path} cannot be resumed, downloading whole file')
+            self._remove_segment_record()
+            return None
+        return record
+
     def download(self):
         logging.info(f'Downloading {self.url} to {self.path}')
         self._create_dir()
-        self.fh = open(self.path, 'wb')
-        self.resp = self.session.get(self.url, stream=True)
+        record = self._load_segment_record()
+        # Partial file of a segmented download has holes, so its size is not the resume offset
+        offset = 0 if record is not None else self._resume_offset()
+        start = perf_counter()
+        self.resp = self.session.get(self.url, stream=True, headers=self._range_headers(offset))
+        self.stats.ttfb = perf_counter() - start
+        if self.resp.status_code == 416:
+            logging.info(f'Partial file {self.partial_path} is not valid for {self.url}, downloading whole file')
+            self.resp.close()
+            offset = 0
+            self.resp = self.session.get(self.url, stream=True)
         self.resp.raise_for_status()
-        for chunk in self.resp.iter_content(chunk_size=self.chunk_size):
-            self.write(chunk)
+        offset = self._response_offset(self.resp.status_code, self.resp.headers, offset)
+        size = self._segmented_size(offset, self.resp.headers, resuming=record is not None)
+        record = self._resumable_segment_record(record, size)
+        if size is not None:
+            self._download_segments(size, record)
+        else:
+            self._open(offset)
+            self._copy_body()
+        self._finish()
+
+    def _copy_body(self):
+        # requests decodes compressed content, keep it this way
+        if 'Content-Encoding' in self.resp.headers:
+            for chunk in self.resp.iter_content(chunk_size=self.chunk_size):
+                self.write(chunk)
+            return
+        free = Queue()
+        filled = Queue()
+        for _ in range(self.pipeline_depth):
+            free.put(bytearray(self.chunk_size))
+        writer_errors = []
+        writer = Thread(target=self._pipeline_writer, args=(free, filled, writer_errors), daemon=True)
+        writer.start()
+        try:
+            while (buffer := free.get()) is not None:
+                n = self.resp.raw.readinto(buffer)
+                filled.put((buffer, n))
+                if n == 0:
+                    break
+        finally:
+            # Stop writer if receiving is failed, it is no-op otherwise
+            filled.put((None, 0))
+            writer.join()
+        if writer_errors:
+            raise writer_errors[0]
+
+    def _pipeline_writer(self, free, filled, errors):
+        """Write and hash buffers from filled queue and give them back to free queue"""
+        try:
+            while True:
+                buffer, n = filled.get()
+                if n == 0:
+                    return
+                self.write(memoryview(buffer)[:n])
+                free.put(buffer)
+        except BaseException as e:
+            errors.append(e)
+            # Unblock receiving thread
+            free.put(None)
+
+    def _check_checksum(self):
         if self.checksum is not None and self.checksum != self.md5.digest().hex():
             msg = f'md5 checksum mismatch for {self.url}'
             logging.warning(msg)
             raise HashSumCheckFailed(msg)
 
+    def _check_gzip(self):
+        if self.gzip is None:
+            return
+        try:
+            self.gzip.finish()
+        except GzipCheckFailed as e:
+            msg = f'{e} for {self.url}'
+            logging.warning(msg)
+            raise GzipCheckFailed(msg) from e
+
+    def _attempts(self):
+        # Partial file can be stale, give an additional attempt to download from scratch.
+        # Corrupted gzip file is usually a broken transfer, give an additional attempt to repeat it immediately
+        return self.retries + (self._partial_size() > 0) + self.validate_gzip
+
     def __enter__(self):
-        for _ in range(self.retries):
+        attempts = self._attempts()
+        for attempt in range(attempts):
+            self.stats.attempts += 1
+            start = perf_counter()
             try:
-                return self.download()
-            except HashSumCheckFailed as e:
+                self.download()
+                self.stats.status = 'downloaded'
+                return
+            except (HashSumCheckFailed, RangeRequestFailed, GzipCheckFailed) as e:
                 exception = e
-            except requests.exceptions.RequestException as e:
+            except RETRIABLE_ERRORS as e:
                 exception = e
-                sleep(1)
+                if attempt + 1 < attempts:
+                    sleep(self._backoff_delay(attempt))
+            finally:
+                self.stats.transfer_time += perf_counter() - start
+                self._close()
+        self._failed(exception)
         raise exception
 
+    def _backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
     def __exit__(self, exc_type, exc_value, traceback):
-        self.fh.close()
-        self.resp.close()
+        self._close()
+
+    def _failed(self, exception):
+        self.stats.status = 'failed'
+        self.stats.error = f'{type(exception).__name__}: {exception}'
+
+    def _close(self):
+        if self.fh is not None:
+            self.fh.close()
+        if self.resp is not None:
+            self.resp.close()
 
     def _write(self, chunk):
         self.fh.write(chunk)
+        self.stats.bytes += len(chunk)
 
-    def _write_and_sum(self, chunk):
+    def _write_and_check(self, chunk):
         self.fh.write(chunk)
-        self.md5.update(chunk)
+        self.stats.bytes += len(chunk)
+        self._check(chunk)
+
+    def _check(self, chunk):
+        """Update md5 and gzip validation with a chunk of file content"""
+        start = perf_counter()
+        if self.checksum is not None:
+            self.md5.update(chunk)
+        if self.gzip is not None:
+            self.gzip.update(chunk)
+        self.stats.hash_time += perf_counter() - start
+
+
+def is_file_downloaded(path, checksum=None):
+    """Check if file exists and its md5 checksum matches
+
+    Checksum recorded in `ChecksumManifest` is used if the file is not changed
+    since then, otherwise checksum is computed and recorded. Files without
+    checksum are never considered as downloaded
+    """
+    if checksum is None or not os.path.exists(path):
+        return False
+    if (recorded := ChecksumManifest.checksum(path)) is not None:
+        if checksum == recorded:
+            logging.info(f'File {path} exists and recorded checksum matches')
+            return True
+        logging.info(f'File {path} exists but recorded checksum differs')
+        return False
+    actual = hash_file(path)
+    if checksum == actual:
+        logging.info(f'File {path} exists and checksum matches')
+        ChecksumManifest.add(path, actual)
+        return True
+    return False
+
+
+def download_file_stats(url, path, checksum=None, session=None, retries=1, raise_on_failure=True):
+    """Download file if it is not downloaded yet and return its `FileStats`
+
+    See call signature in `FileDownloader`. If `raise_on_failure` is False,
+    a download failed with one of `RETRIABLE_ERRORS` is returned with "failed"
+    status instead of raising
+    """
+    start = perf_counter()
+    if is_file_downloaded(path, checksum):
+        return FileStats(url=url, path=path, status='skipped', size=os.path.getsize(path),
+                         hash_time=perf_counter() - start)
+    downloader = FileDownloader(url, path, checksum=checksum, session=session, retries=retries)
+    try:
+        with downloader:
+            return downloader.stats
+    except RETRIABLE_ERRORS:
+        if raise_on_failure:
+            raise
+        return downloader.stats
 
 
 def download_file(url, path, checksum=None, session=None, retries=1):
     """Download file and optionally checks its md5 checksum
 
-    See call signature in `FileDownloader`
+    See call signature in `FileDownloader`. Statistics of the download is added
+    to the report of the current process, see `get_report`
 
     Returns
     -------
     - True if file is downloaded
     - False if file exists and checksum matches
     """
-    if os.path.exists(path):
-        if checksum is not None and checksum == hash_file(path):
-            logging.info(f'File {path} exists and checksum matches')
+    stats = download_file_stats(url, path, checksum=checksum, session=session, retries=retries)
+    get_report().add(stats)
+    return stats.status == 'downloaded'
+
+
+def _download_task(task):
+    return download_file_stats(*task, raise_on_failure=False)
+
+
+def unexpected_failure(task, exception):
+    """`FileStats` of a task failed with an exception which is not worth retrying"""
+    url, path, *_ = task
+    error = f'{type(exception).__name__}: {exception}'
+    logging.warning(f'Downloading {url} failed: {error}')
+    return FileStats(url=url, path=path, status='failed', error=error)
+
+
+class DeferredRetries:
+    """Queue of failed tasks waiting for their next round
+
+    A task failed `n` times is ready to be retried after `backoff_delay(n - 1)`
+    seconds. Tasks failed more than `rounds` times are given up. Statistics
+    of the failed rounds are kept and added to the statistics of the last
+    round, so a file is reported once with all its attempts and bytes.
+
+    Arguments
+    ---------
+    rounds : int
+        Maximum number of deferred retries of a single task
+    delay : float
+        Base delay before the first retry in seconds
+    max_delay : float
+        Maximum delay before a retry in seconds
+    """
+
+    def __init__(self, rounds=DEFAULT_RETRY_ROUNDS, delay=DEFAULT_RETRY_DELAY, max_delay=600.0):
+        self.rounds = rounds
+        self.delay = delay
+        self.max_delay = max_delay
+        self.heap = []
+        # Path -> number of failed rounds and their total statistics
+        self.failures = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    @staticmethod
+    def _add_previous(stats, previous):
+        stats.attempts += previous.attempts
+        stats.bytes += previous.bytes
+        stats.transfer_time += previous.transfer_time
+        stats.hash_time += previous.hash_time
+
+    def defer(self, task, stats):
+        """Defer failed task if it has rounds left, returns False if the task is finished
+
+        Statistics of the previous rounds are added to `stats` of a finished
+        task
+        """
+        n, previous = self.failures.pop(task[1], (0, None))
+        # Failures with no attempts are unexpected exceptions, they are not going to go away
+        retry = stats.status == 'failed' and stats.attempts > 0 and n < self.rounds
+        if previous is not None:
+            self._add_previous(stats, previous)
+        if not retry:
             return False
-    with FileDownloader(url, path, checksum=checksum, session=session, retries=retries):
+        n += 1
+        self.failures[task[1]] = (n, stats)
+        delay = backoff_delay(n - 1, self.delay, self.max_delay)
+        logging.warning(f'Downloading {task[0]} failed: {stats.error}, retry {n} of {self.rounds} in {delay:.0f} s')
+        # Counter keeps heap from comparing tasks and preserves FIFO order for equal times
+        heapq.heappush(self.heap, (monotonic() + delay, self.counter, task))
+        self.counter += 1
         return True
 
+    def pop_ready(self):
+        """Task which delay is over or None"""
+        if self.heap and self.heap[0][0] <= monotonic():
+            return heapq.heappop(self.heap)[-1]
+        return None
+
+    def time_to_next(self):
+        """Seconds until the next task is ready, None if there are no tasks"""
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - monotonic())
+
+
+class MirrorRouter:
+    """Route downloads to the fastest of several base URLs serving the same files
+
+    Every mirror has the same layout as `base_url`, a file URL starting with
+    `base_url` is downloaded from the mirror which is expected to transfer a
+    file of `reference_size` bytes first. Latency and throughput of the
+    mirrors are probed with a ranged request of `probe_size` bytes of the
+    first routed file and then updated with exponential smoothing from the
+    statistics of every downloaded file, so routing follows mirror
+    performance during the run. A mirror failing `failure_limit` files in a
+    row is not used for `cooldown` seconds, a file is not retried from the
+    mirror it has just failed on while there are other mirrors.
+
+    Tasks and statistics keep the original URL, so sync records and size
+    cache don't depend on the mirror used. Listings and checksum files under
+    `base_url` are fetched by `fetch` from the best mirror, failing over to
+    the others.
+
+    Arguments
+    ---------
+    base_url : str
+        Original base URL of catalog files
+    mirrors : list of str
+        Alternative base URLs
+    """
+
+    reference_size = 1 << 26
+    probe_size = 1 << 22
+    failure_limit = 3
+    cooldown = 300.0
+    smoothing = 0.3
+
+    def __init__(self, base_url, mirrors):
+        self.base_url = base_url
+        self.sources = {}
+        for url in [base_url, *mirrors]:
+            self.sources.setdefault(url, {'latency': None, 'throughput': None, 'failures': 0, 'down_until': 0.0})
+        self.last_failed = {}
+        self.current = None
+        self.probed = False
+        # Tasks can be routed from several threads, mirrors are probed once
+        self.probe_lock = Lock()
+
+    def _mirror_url(self, source, url):
+        return f'{source}{url[len(self.base_url):]}'
+
+    def _probe_source(self, source, url, session):
+        stats = self.sources[source]
+        mirror_url = self._mirror_url(source, url)
+        start = monotonic()
+        try:
+            with session.get(mirror_url, headers={'Range': f'bytes=0-{self.probe_size - 1}'}, stream=True,
+                             timeout=60) as resp:
+                resp.raise_for_status()
+                ttfb = monotonic() - start
+                n = 0
+                for chunk in resp.iter_content(chunk_size=1 << 16):
+                    n += len(chunk)
+                    if n >= self.probe_size:
+                        break
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Mirror {source} is not available: {e}')
+            stats['down_until'] = monotonic() + self.cooldown
+            return
+        stats['latency'] = ttfb
+        stats['throughput'] = n / max(monotonic() - start - ttfb, 1e-6)
+        logging.warning(f'Mirror {source}: latency is {ttfb * 1e3:.0f} ms, '
+                        f'throughput is {format_bytes(stats["throughput"])}/s')
+
+    def probe(self, url, session=None):
+        """Measure latency and throughput of all mirrors downloading the beginning of the file"""
+        session = session or get_session()
+        for source in self.sources:
+            self._probe_source(source, url, session)
+        self.probed = True
+
+    def _expected_time(self, source):
+        stats = self.sources[source]
+        if stats['throughput'] is None:
+            return None
+        return stats['latency'] + self.reference_size / stats['throughput']
+
+    def _ranked(self, candidates):
+        expected = {source: self._expected_time(source) for source in candidates}
+        # Mirrors back from cooldown have no measurements, they get a chance as if they were the fastest
+        best_known = min((t for t in expected.values() if t is not None), default=0.0)
+        return sorted(candidates, key=lambda source: best_known if expected[source] is None else expected[source])
+
+    def fetch(self, url, fetch):
+        """Result of fetch(mirror_url) for the best mirror of url, the next mirror is tried if fetch fails
+
+        URLs not under `base_url` are fetched as is. A failed mirror is not
+        used for `cooldown` seconds.
+        """
+        if not url.startswith(self.base_url):
+            return fetch(url)
+        now = monotonic()
+        available = [source for source, stats in self.sources.items() if stats['down_until'] <= now]
+        down = [source for source in self.sources if source not in available]
+        exception = None
+        for source in self._ranked(available) + down:
+            try:
+                return fetch(self._mirror_url(source, url))
+            except requests.exceptions.RequestException as e:
+                logging.warning(f'Cannot fetch {url} from {source}: {e}')
+                self.sources[source]['down_until'] = monotonic() + self.cooldown
+                exception = e
+        raise exception
+
+    def route(self, task):
+        """Task with URL of the best mirror and the mirror, the mirror is None for URLs not under `base_url`"""
+        url, path, *rest = task
+        if not url.startswith(self.base_url):
+            return task, None
+        with self.probe_lock:
+            if not self.probed:
+                self.probe(url)
+        now = monotonic()
+        candidates = [source for source, stats in self.sources.items() if stats['down_until'] <= now]
+        if len(candidates) > 1 and self.last_failed.get(path) in candidates:
+            candidates.remove(self.last_failed[path])
+        if not candidates:
+            candidates = list(self.sources)
+        source = self._ranked(candidates)[0]
+        if source != self.current:
+            logging.warning(f'Downloading from {source}')
+            self.current = source
+        return (self._mirror_url(source, url), path, *rest), source
+
+    def record(self, source, task, stats):
+        """Update mirror statistics with a file downloaded by a task returned by `route`"""
+        if source is None:
+            return
+        stats.url = task[0]
+        stats.mirror = None if source == self.base_url else source
+        mirror = self.sources[source]
+        if stats.status == 'failed':
+            self.last_failed[task[1]] = source
+            # Files which were in flight when the mirror was put to cooldown
+            if mirror['down_until'] > monotonic():
+                return
+            mirror['failures'] += 1
+            if mirror['failures'] >= self.failure_limit:
+                logging.warning(f'Mirror {source} failed {mirror["failures"]} files in a row, it is not used for '
+                                f'{self.cooldown:.0f} s')
+                mirror.update(failures=0, down_until=monotonic() + self.cooldown, latency=None, throughput=None)
+            return
+        if stats.status != 'downloaded':
+            return
+        self.last_failed.pop(task[1], None)
+        mirror['failures'] = 0
+        # Small transfers say little about throughput
+        if stats.bytes < DEFAULT_READ_CHUNK or stats.transfer_time <= 0.0 or stats.ttfb is None:
+            return
+        throughput = stats.bytes / stats.transfer_time
+        if mirror['throughput'] is None:
+            mirror.update(latency=stats.ttfb, throughput=throughput)
+            return
+        mirror['latency'] += self.smoothing * (stats.ttfb - mirror['latency'])
+        mirror['throughput'] += self.smoothing * (throughput - mirror['throughput'])
+
+
+def _download_with_pool(cli_args, tasks, report, deferred, router=None):
+    """Run tasks in process pool keeping a bounded number of them in flight
+
+    Failed tasks are deferred and submitted again when their delay is over
+    while other tasks are being downloaded. Every submitted task is routed
+    to a mirror by `router` if it is given.
+    """
+    window = 2 * cli_args.jobs
+    results = Queue()
+    tasks = iter(tasks)
+    in_flight = 0
+    with process_pool(cli_args) as pool:
+        while True:
+            while in_flight < window:
+                if (task := deferred.pop_ready()) is None and (task := next(tasks, None)) is None:
+                    break
+                fetch_task, source = (task, None) if router is None else router.route(task)
+                pool.apply_async(
+                    _download_task,
+                    (fetch_task,),
+                    callback=lambda stats, task=task, source=source: results.put((task, source, stats)),
+                    error_callback=lambda e, task=task, source=source, fetch_task=fetch_task: results.put(
+                        (task, source, unexpected_failure(fetch_task, e))
+                    ),
+                )
+                in_flight += 1
+            if in_flight == 0 and len(deferred) == 0:
+                return
+            try:
+                task, source, stats = results.get(timeout=deferred.time_to_next())
+            except Empty:
+                continue
+            in_flight -= 1
+            if router is not None:
+                router.record(source, task, stats)
+            if not deferred.defer(task, stats):
+                report.add(stats)
+
+
+def _head(url, session=None):
+    """Response to HEAD request, None if it failed"""
+    session = session or get_session()
+    try:
+        resp = session.head(url, allow_redirects=True)
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.warning(f'HEAD request for {url} failed: {e}')
+        return None
+    return resp
+
+
+def _content_length(resp):
+    """Size of the remote file from the response headers, None if it is unknown"""
+    if 'Content-Encoding' in resp.headers or (size := resp.headers.get('Content-Length')) is None:
+        return None
+    return int(size)
+
+
+def remote_size(url, session=None):
+    """Size of the remote file got with HEAD request, None if it is unknown"""
+    if (resp := _head(url, session)) is None:
+        return None
+    return _content_length(resp)
+
+
+def is_file_same_as_remote(url, path, session=None):
+    """Compare size and modification time of the local file with HTTP headers of remote one
+
+    File is considered to be the same if its size is equal to Content-Length
+    and it is not older than Last-Modified, if the header is presented. Returns
+    False if file doesn't exist or remote file cannot be checked.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if (resp := _head(url, session)) is None or (size := _content_length(resp)) is None:
+        return False
+    if size != stat.st_size:
+        logging.info(f'File {path} size differs from the remote one')
+        return False
+    if (mtime := http_date_to_timestamp(resp.headers.get('Last-Modified'))) is not None and stat.st_mtime < mtime:
+        logging.info(f'File {path} is older than the remote one')
+        return False
+    logging.info(f'File {path} has the same size as the remote one and is up to date')
+    return True
+
+
+def skip_same_as_remote(tasks, report=None, threads=DEFAULT_HEAD_THREADS):
+    """Filter out tasks without checksum which local files look the same as remote ones
+
+    HEAD requests are sent in parallel for existing files, see
+    `is_file_same_as_remote`. Skipped files are added to `report` if it is
+    given.
+    """
+    tasks = list(tasks)
+    to_check = [task for task in tasks if len(task) < 3 or task[2] is None]
+    session = new_session(pool_size=threads)
+    with ThreadPool(processes=threads) as pool:
+        same = pool.starmap(is_file_same_as_remote, ((url, path, session) for url, path, *_ in to_check))
+    skip = {task[1] for task, is_same in zip(to_check, same) if is_same}
+    logging.info(f'{len(skip)} of {len(to_check)} files without checksums are up to date')
+    if report is not None:
+        for url, path, *_ in to_check:
+            if path in skip:
+                report.add(FileStats(url=url, path=path, status='skipped', size=os.path.getsize(path)))
+    return [task for task in tasks if task[1] not in skip]
+
+
+def parse_shard(s):
+    """Parse "I/N" shard specification into (I, N) tuple, I is zero-based"""
+    try:
+        index, count = map(int, s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be specified as I/N, not "{s}"')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be in [0, N) range, not "{s}"')
+    return index, count
+
+
+def task_size(task):
+    """Expected file size of the task in bytes, None if it is unknown"""
+    return task[3] if len(task) > 3 else None
+
+
+def shard_tasks(tasks, index, count):
+    """Tasks of the shard `index` of `count` shards
+
+    Tasks are assigned to shards with longest-processing-time-first heuristic:
+    from the largest to the smallest, each task goes to the shard with the
+    least total size. Tasks of unknown size are counted as the mean of the
+    known sizes. The split depends only on URLs and sizes, so independent
+    processes get disjoint shards covering all tasks, whatever their
+    destination directories and the order of tasks are.
+    """
+    tasks = list(tasks)
+    known = [size for task in tasks if (size := task_size(task)) is not None]
+    mean = sum(known) / len(known) if known else 1.0
+    weights = [mean if (size := task_size(task)) is None else size for task in tasks]
+    order = sorted(range(len(tasks)), key=lambda i: (-weights[i], tasks[i][0]))
+    loads = [(0.0, shard) for shard in range(count)]
+    selected = []
+    for i in order:
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            selected.append(tasks[i])
+        heapq.heappush(loads, (load + weights[i], shard))
+    logging.info(f'Shard {index}/{count} has {len(selected)} of {len(tasks)} files')
+    return selected
+
+
+def resolve_sizes(tasks, probe=False, threads=DEFAULT_HEAD_THREADS):
+    """Expected file sizes of tasks, None for unknown ones
+
+    Sizes are taken from tasks, then from the size cache, see
+    `configure_downloader`. If `probe` is True, sizes still unknown are got
+    with parallel HEAD requests and recorded to the size cache.
+    """
+    sizes = [task_size(task) for task in tasks]
+    if _size_cache is not None:
+        sizes = [_size_cache.get(task[0]) if size is None else size for task, size in zip(tasks, sizes)]
+    unknown = [i for i, size in enumerate(sizes) if size is None]
+    if probe and unknown:
+        logging.info(f'Requesting sizes of {len(unknown)} files')
+        session = new_session(pool_size=threads)
+        with ThreadPool(processes=threads) as pool:
+            probed = pool.starmap(remote_size, ((tasks[i][0], session) for i in unknown))
+        for i, size in zip(unknown, probed):
+            sizes[i] = size
+        if _size_cache is not None:
+            _size_cache.update({tasks[i][0]: size for i, size in zip(unknown, probed) if size is not None})
+    logging.info(f'Sizes of {sum(size is not None for size in sizes)} of {len(tasks)} files are known')
+    return sizes
+
+
+def largest_first(tasks, probe=False, threads=DEFAULT_HEAD_THREADS):
+    """Sort tasks by expected file size in descending order
+
+    See `resolve_sizes` for sizes source. Tasks of unknown size are placed as
+    if they have the mean known size, the sort is stable.
+    """
+    tasks = list(tasks)
+    sizes = resolve_sizes(tasks, probe=probe, threads=threads)
+    known = [size for size in sizes if size is not None]
+    mean = sum(known) / len(known) if known else 0
+    order = sorted(range(len(tasks)), key=lambda i: -(mean if sizes[i] is None else sizes[i]))
+    return [tasks[i] for i in order]
+
+
+def partial_bytes(path):
+    """Number of bytes downloaded to the partial file of path
+
+    Partial file of a segmented download is preallocated, its downloaded
+    byte ranges are read from its record, see `FileDownloader`
+    """
+    partial_path = f'{path}{FileDownloader.partial_suffix}'
+    try:
+        with open(f'{partial_path}{FileDownloader.segments_suffix}') as fh:
+            return sum(stop - start for start, stop in json.load(fh)['done'])
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    try:
+        return os.path.getsize(partial_path)
+    except FileNotFoundError:
+        return 0
+
+
+def _bytes_left(task, size, verify_size):
+    """Number of bytes to download for a task, zero if file is already downloaded, None if it is unknown"""
+    url, path, *checksum = task
+    checksum = checksum[0] if checksum else None
+    if checksum is not None and is_file_downloaded(path, checksum):
+        return 0
+    if size is None:
+        return None
+    if checksum is None and verify_size:
+        try:
+            if os.path.getsize(path) == size:
+                return 0
+        except FileNotFoundError:
+            pass
+    partial_size = partial_bytes(path)
+    return size - partial_size if 0 < partial_size <= size else size
+
+
+def _existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def plan_downloads(cli_args, tasks, threads=DEFAULT_HEAD_THREADS):
+    """Estimate what `download_files` would do and print it without downloading anything
+
+    File sizes are got with HEAD requests if they are unknown. Files with
+    checksums are checked like `download_files` does, files without checksums
+    are considered as downloaded only with `--verify-size` if their size
+    matches. Estimated time is based on throughput of the recent runs for the
+    same catalog, see `ThroughputHistory`.
+    """
+    tasks = list(tasks)
+    sizes = resolve_sizes(tasks, probe=True, threads=threads)
+    # Local files are checked in threads, hashlib releases GIL for large buffers
+    with ThreadPool(processes=threads) as pool:
+        left = pool.starmap(_bytes_left, ((task, size, cli_args.verify_size) for task, size in zip(tasks, sizes)))
+    to_download = [n for n in left if n != 0]
+    unknown = sum(n is None for n in left)
+    total = sum(n for n in to_download if n is not None)
+    dest = _existing_parent(cli_args.dir)
+    free = shutil.disk_usage(dest).free
+
+    print(f'{len(tasks)} files, {len(tasks) - len(to_download)} are already downloaded, '
+          f'{len(to_download)} to download')
+    print(f'{format_bytes(total)} to download' + (f', sizes of {unknown} files are unknown' if unknown else ''))
+    print(f'{format_bytes(free)} free at {dest}')
+    if total > free:
+        print('WARNING: not enough free disk space')
+    throughput = None if cli_args.no_cache else throughput_history(cli_args).recent(cli_args.catalog)
+    if throughput is None:
+        print('Estimated time is unknown, no throughput measured by previous runs')
+    else:
+        print(f'Estimated time is {format_duration(total / throughput)} at {format_bytes(throughput)}/s '
+              f'measured by previous runs')
+
+
+def throughput_history(cli_args):
+    return ThroughputHistory(os.path.join(cli_args.cache_dir, 'throughput.jsonl'))
+
+
+def _collect_tasks(tasks, listed):
+    """Yield tasks appending them to `listed`"""
+    for task in tasks:
+        listed.append(task)
+        yield task
+
+
+def _probe_first_mirrored(router, tasks, base_url):
+    """Probe mirrors with the first task under base_url, returns tasks with the ones consumed to find it"""
+    tasks = iter(tasks)
+    head = []
+    for task in tasks:
+        head.append(task)
+        if task[0].startswith(base_url):
+            router.probe(task[0])
+            break
+    return chain(head, tasks)
+
+
+def download_files(cli_args, tasks, base_url=None):
+    """Download multiple files using the engine selected by --engine
+
+    Arguments
+    ---------
+    cli_args : argparse.Namespace
+        Parsed command line arguments, `dir`, `catalog`, `engine`, `jobs`,
+        `per_host`, `concurrency`, `rate`, `shard`, `sync`, `plan`, `order`,
+        `probe_sizes`, `stripe_dir`, `mirror`, `retry_rounds`, `retry_delay`
+        and `verify_size` are used
+    tasks : iterable of tuples
+        `(url, path)`, `(url, path, checksum)` or `(url, path, checksum, size)`
+        tuples, see `download_file`, size is expected file size in bytes or
+        None, it is used to balance shards
+    base_url : str or None
+        Base URL of the catalog files, files under it are downloaded from the
+        fastest of it and `--mirror` URLs, see `MirrorRouter`
+
+    Only files of the shard given by `--shard` are downloaded, see
+    `shard_tasks`. With `--sync` only files added or changed since the last
+    run are downloaded, see `SyncRecord`. With `--plan` nothing is
+    downloaded, see `plan_downloads`. Files are downloaded from the largest to
+    the smallest if `--order=largest`, see `largest_first`. Files are spread
+    over the destination directory and `--stripe-dir` roots, see
+    `StripePlacement`. Files listed in tasks are recorded to the inventory of
+    the destination directory, see `Inventory`.
+
+    Statistics of every file is added to the report of the current process,
+    see `get_report`. A failed file doesn't stop the others, it is retried
+    later up to `--retry-rounds` times, see `DeferredRetries`. `DownloadFailed`
+    is raised when all files are processed if some of them are still failed.
+    """
+    report = get_report()
+    deferred = DeferredRetries(rounds=cli_args.retry_rounds, delay=cli_args.retry_delay)
+    n_files = len(report.files)
+    if cli_args.shard is not None:
+        tasks = shard_tasks(tasks, *cli_args.shard)
+    if cli_args.shard is not None or cli_args.sync:
+        tasks = listed = list(tasks)
+    else:
+        # Downloads start while the catalog is still being listed
+        listed = []
+        tasks = _collect_tasks(tasks, listed)
+    sync_record = SyncRecord.for_run(cli_args, base_url)
+    if cli_args.sync:
+        tasks = sync_record.changed(tasks, report_removed=cli_args.shard is None)
+    if cli_args.plan:
+        plan_downloads(cli_args, tasks)
+        return
+    if cli_args.order == 'largest':
+        tasks = largest_first(tasks, probe=cli_args.probe_sizes)
+    if cli_args.stripe_dir:
+        placement = StripePlacement(cli_args.dir, cli_args.stripe_dir)
+        # Placement depends on sizes of all files
+        tasks = list(tasks)
+        tasks = placement.place(tasks, resolve_sizes(tasks))
+    router = mirror_router(base_url)
+    if cli_args.mirror and base_url is None:
+        logging.warning(f'{cli_args.catalog} files are not known to be mirrored, --mirror is ignored')
+    if router is not None and not router.probed:
+        tasks = _probe_first_mirrored(router, tasks, base_url)
+    tasks = (task[:3] for task in tasks)
+    if cli_args.verify_size:
+        tasks = skip_same_as_remote(tasks, report=report)
+    if cli_args.engine == 'asyncio':
+        from download_cats.aio import download_files_async
+
+        download_files_async(tasks, connections=cli_args.jobs, per_host=cli_args.per_host, rate=cli_args.rate,
+                             adaptive=cli_args.concurrency == 'adaptive', report=report, deferred=deferred,
+                             router=router)
+    else:
+        _download_with_pool(cli_args, tasks, report, deferred, router)
+    files = report.files[n_files:]
+    if _size_cache is not None:
+        _size_cache.update({stats.url: stats.size for stats in files if stats.size is not None})
+    # Failed files are not recorded, so the next --sync run retries them
+    failed = {stats.url for stats in files if stats.status == 'failed'}
+    listing = {task[0]: task[2] for task in listed if len(task) > 2 and task[2] is not None}
+    sync_record.save({url: checksum for url, checksum in listing.items() if url not in failed})
+    Inventory(cli_args.dir).update(listed, files)
+    if (n_failed := sum(stats.status == 'failed' for stats in files)) > 0:
+        report.log_failures()
+        raise DownloadFailed(f'{n_failed} files failed to download, see the log above')
+
 
 def parse_checksums(s):
     """Extract filename-checksums pairs from checksums file content"""
@@ -138,14 +1803,61 @@ def parse_checksums(s):
     return checksums
 
 
-def url_text_content(url, session=None):
-    """String representation of URL content"""
-    session = session or requests
+# HTTP and file size caches and --mirror URLs of the current process, see configure_downloader
+_http_cache = None
+_size_cache = None
+_mirrors = []
+
+# Base URL -> MirrorRouter, see mirror_router
+_routers = {}
+
+
+def mirror_router(base_url):
+    """`MirrorRouter` of base_url and --mirror URLs shared by listing and downloads, None if it is not mirrored"""
+    if base_url is None or not _mirrors:
+        return None
+    try:
+        return _routers[base_url]
+    except KeyError:
+        router = _routers[base_url] = MirrorRouter(base_url, _mirrors)
+        return router
+
+
+def _fetch_text(url, session):
+    if _http_cache is not None:
+        return _http_cache.text(url, session)
     resp = session.get(url)
     resp.raise_for_status()
     return resp.text
 
 
+def url_text_content(url, session=None, base_url=None):
+    """String representation of URL content
+
+    Content is cached if HTTP cache is enabled. URLs under base_url are
+    fetched from the best of it and --mirror URLs, see `MirrorRouter.fetch`
+    """
+    session = session or get_session()
+    if (router := mirror_router(base_url)) is not None:
+        return router.fetch(url, lambda url: _fetch_text(url, session))
+    return _fetch_text(url, session)
+
+
+def url_parsed_content(url, parse, session=None, base_url=None):
+    """Returns parse(text) for URL content
+
+    Both content and JSON-serializable result of parse are cached if HTTP
+    cache is enabled. URLs under base_url are fetched from the best of it
+    and --mirror URLs, see `MirrorRouter.fetch`
+    """
+    session = session or get_session()
+    if _http_cache is None:
+        return parse(url_text_content(url, session, base_url=base_url))
+    if (router := mirror_router(base_url)) is not None:
+        return router.fetch(url, lambda url: _http_cache.parsed(url, parse, session))
+    return _http_cache.parsed(url, parse, session)
+
+
 def subclasses(cls):
     return set(cls.__subclasses__()).union(subcls for c in cls.__subclasses__() for subcls in subclasses(c))
 
@@ -170,8 +1882,70 @@ def configure_logging(cli_args):
     logging.basicConfig(level=logging_level)
 
 
+def configure_downloader(cli_args):
+    """Set `FileDownloader` and `ChecksumManifest` class attributes and caches from command line arguments"""
+    global _http_cache, _size_cache, _mirrors
+
+    _mirrors = list(cli_args.mirror)
+    _routers.clear()
+    FileDownloader.chunk_size = cli_args.chunk_size << 20
+    FileDownloader.segments = cli_args.segments
+    FileDownloader.segment_threshold = cli_args.segment_threshold << 20
+    FileDownloader.check_gzip = cli_args.check_gzip
+    ChecksumManifest.rehash = cli_args.rehash
+    if cli_args.no_cache:
+        _http_cache = None
+        _size_cache = None
+    else:
+        _http_cache = HttpCache(cli_args.cache_dir, max_age=cli_args.cache_max_age)
+        _size_cache = SizeCache(cli_args.cache_dir)
+
+
+# Download statistics of the current process, see get_report
+_report = None
+
+
+def get_report():
+    """`DownloadReport` collecting statistics of all files downloaded by the current process"""
+    global _report
+    if _report is None:
+        _report = DownloadReport()
+    return _report
+
+
+# Session of the current process, see get_session
+_session = None
+
+
+def new_session(pool_size=None):
+    """Create requests.Session keeping enough connections for segmented downloads"""
+    session = requests.Session()
+    pool_size = max(requests.adapters.DEFAULT_POOLSIZE, FileDownloader.segments, pool_size or 0)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Long-lived requests.Session of the current process
+
+    It keeps connections alive between files, so TCP and TLS handshakes are
+    not repeated for every file downloaded from the same host
+    """
+    global _session
+    if _session is None:
+        _session = new_session()
+    return _session
+
+
 def pool_initializer(cli_args):
+    global _session
+
     configure_logging(cli_args)
+    configure_downloader(cli_args)
+    # Connections of the session inherited from the parent process must not be shared
+    _session = new_session()
 
 
 def process_pool(cli_args, **kwargs):
@@ -183,5 +1957,6 @@ def process_pool(cli_args, **kwargs):
     )
 
 
-__all__ = ('hash_file', 'parse_checksums', 'download_file', 'url_text_content', 'Everything', 'configure_logging',
-           'process_pool',)
+__all__ = ('DownloadFailed', 'hash_file', 'parse_checksums', 'download_file', 'download_files', 'url_text_content',
+           'url_parsed_content', 'Everything', 'configure_logging', 'configure_downloader', 'get_session',
+           'get_report', 'process_pool', 'throughput_history',)
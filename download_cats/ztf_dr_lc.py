@@ -26,14 +26,13 @@ class ZtfDrLcFetcher(BaseFetcher):
 
     def __call__(self):
         logging.info(f'Fetching ZTF DR{self.dr} light curve data')
-        checksums = parse_checksums(url_text_content(self.checksums_url))
-        with process_pool(self.cli_args) as pool:
-            pool.starmap(
-                download_file,
-                ((urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
-                 for fname, checksum in checksums.items()),
-                chunksize=1
-            )
+        checksums = url_parsed_content(self.checksums_url, parse_checksums, base_url=self.base_url)
+        download_files(
+            self.cli_args,
+            ((urljoin(self.base_url, fname), os.path.join(self.dest, fname), checksum)
+             for fname, checksum in checksums.items()),
+            base_url=self.base_url,
+        )
 
     @staticmethod
     def add_arguments_to_parser(parser):
@@ -20,7 +20,8 @@ class ZtfMetadataFetcher(BaseFetcher):
 
     def __call__(self):
         logging.info(f'Fetching ZTF metadata database')
-        download_file(self.url, os.path.join(self.dest, 'ztf_metadata_latest.db'))
+        download_files(self.cli_args, [(self.url, os.path.join(self.dest, 'ztf_metadata_latest.db'))],
+                       base_url=urljoin(self.url, '.'))
 
     @staticmethod
     def add_arguments_to_parser(parser):
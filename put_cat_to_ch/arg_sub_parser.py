@@ -1,9 +1,10 @@
 from argparse import ArgumentParser, Namespace
 
+from put_cat_to_ch.ch_client import DEFAULT_INSERT_BLOCK_SIZE
 from put_cat_to_ch.putter import PutterMeta
 
 
-__all__ = ('ArgSubParser',)
+__all__ = ('ArgSubParser', 'add_insert_method_arguments',)
 
 
 def _action_type(s):
@@ -12,6 +13,30 @@ def _action_type(s):
     return s
 
 
+def _compression_type(s):
+    s = s.lower()
+    if s == 'none':
+        return False
+    return s
+
+
+def add_insert_method_arguments(parser: ArgumentParser):
+    """Add arguments of putters which can insert either by clickhouse-client or by `NativeInserter`"""
+    parser.add_argument('--insert-method', default='client', type=str.lower, choices=('client', 'native'),
+                        help='"client" pipes RowBinary data to clickhouse-client, "native" sends numpy column blocks '
+                             'over ClickHouse native protocol from this process')
+    parser.add_argument('--insert-streams', default=1, type=int,
+                        help='number of concurrent INSERT queries, every one has its own connection or '
+                             'clickhouse-client process')
+    parser.add_argument('--block-size', default=DEFAULT_INSERT_BLOCK_SIZE, type=int,
+                        help='minimum number of rows in a single INSERT query for "native" insert method, '
+                             'memory usage is proportional to it')
+    parser.add_argument('--compression', default=False, type=_compression_type,
+                        choices=(False, 'lz4', 'lz4hc', 'zstd'), metavar='{none,lz4,lz4hc,zstd}',
+                        help='compression of data blocks for "native" insert method, lz4 and zstd '
+                             'require clickhouse-driver[lz4] or clickhouse-driver[zstd]')
+
+
 class ArgSubParser:
     command: str
     putter_cls: PutterMeta
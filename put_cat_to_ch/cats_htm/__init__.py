@@ -6,7 +6,6 @@ import os
 import re
 from collections import Counter
 from functools import lru_cache
-from glob import glob
 from multiprocessing.pool import ThreadPool
 from typing import BinaryIO, Iterable, List, Tuple
 
@@ -20,7 +19,7 @@ from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.cats_htm import sh, sql
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import remove_files_and_directory
+from put_cat_to_ch.utils import data_files, placed_path, remove_files_and_directory
 
 
 __all__ = ('CatsHtmPutter', 'CatsHtmArgSubParser',)
@@ -33,6 +32,11 @@ def get_name_dir_dict(data_dir):
     return d
 
 
+def hdf5_paths(data_dir, path):
+    """HDF5 files of a catalog directory, including files put to other directories by download_cats --stripe-dir"""
+    return data_files(data_dir, os.path.join(os.path.relpath(path, data_dir), '*.hdf5'))
+
+
 class SingleCatHtm:
     dataset_name_re = re.compile(r'^htm_\d+$')
 
@@ -42,11 +46,11 @@ class SingleCatHtm:
         self.putter = putter
         self.path = path
         self.name = name
-        self.htm_col_cell_path = os.path.join(self.path, f'{self.name}_htmColCell.mat')
+        self.htm_col_cell_path = placed_path(putter.data_dir, os.path.join(self.path, f'{self.name}_htmColCell.mat'))
         self.htm_col_cell = loadmat(self.htm_col_cell_path)
         self.col_names = tuple(np.concatenate(self.htm_col_cell['ColCell'].flatten()))
         self.col_units = tuple('dimensionless' if a.size == 0 else a[0] for a in self.htm_col_cell['ColUnits'].flat)
-        self.hdf5_paths = tuple(sorted(glob(os.path.join(self.path, '*.hdf5'))))
+        self.hdf5_paths = tuple(hdf5_paths(putter.data_dir, self.path))
         
         self._check_columns(self._prepare_column_names_for_ch(), self.col_units)
 
@@ -144,9 +148,7 @@ class CatsHtmPutter(CHPutter):
 
         name_path = {}
         for name, path in get_name_dir_dict(dir).items():
-            if not os.path.isdir(path):
-                continue
-            if not any(f.endswith(b'.hdf5') for f in os.listdir(path)):
+            if not hdf5_paths(dir, path):
                 continue
             name_path[name] = path
 
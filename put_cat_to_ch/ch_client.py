@@ -2,11 +2,15 @@ import logging
 from importlib.resources import read_text
 from subprocess import check_call
 from types import ModuleType
-from typing import List, Tuple
+from typing import List, Sequence, Tuple, Union
 
+import numpy as np
 from clickhouse_driver import Client as RemoteClient
 
 
+DEFAULT_INSERT_BLOCK_SIZE = 1 << 18
+
+
 # Duck-typed to be compatible with clickhouse_driver.Client
 class LocalClient:
     """Use "clickhouse local" instead of remote client"""
@@ -121,3 +125,74 @@ class CHClient:
         msg = f'on_exists must be one of "fail" or "keep" or "drop", not {on_exists}'
         logging.warning(msg)
         raise ValueError(msg)
+
+
+class NativeInserter:
+    """Insert numpy columns into a table over ClickHouse native protocol
+
+    It has its own connection with use_numpy and strings_as_bytes client
+    settings, so columns are sent as they are without row-oriented
+    serialisation. Columns added by `add` are buffered and sent as a single
+    INSERT query when there are at least `block_size` rows, so small files
+    don't produce small parts. Columns are copied when they are added, so
+    they may be views of a reused buffer. Call `flush` or use it as a
+    context manager to send the rest.
+
+    Parameters
+    ----------
+    table : str
+        Table name including database
+    columns : sequence of str
+        Column names in the order of the arrays passed to `add`
+    block_size : int
+        Minimum number of rows in a single INSERT query and a data block,
+        memory usage is proportional to it
+    compression : str or bool
+        Compression of data blocks: False, True or 'lz4', 'lz4hc', 'zstd',
+        clickhouse-driver[lz4] or clickhouse-driver[zstd] extras are
+        required for compression
+    **client_kwargs
+        clickhouse_driver.Client keyword arguments
+    """
+
+    def __init__(self, table: str, columns: Sequence[str], *, block_size: int = DEFAULT_INSERT_BLOCK_SIZE,
+                 compression: Union[str, bool] = False, **client_kwargs):
+        self.block_size = block_size
+        self.query = f'INSERT INTO {table} ({", ".join(columns)}) VALUES'
+        settings = dict(client_kwargs.pop('settings', None) or {}, use_numpy=True, strings_as_bytes=True,
+                        insert_block_size=block_size)
+        self.client = RemoteClient(compression=compression, settings=settings, **client_kwargs)
+        self.pending = []
+        self.pending_rows = 0
+        self.inserted_rows = 0
+
+    def add(self, columns: Sequence[np.ndarray]):
+        self.pending.append([np.array(column) for column in columns])
+        self.pending_rows += len(columns[0])
+        if self.pending_rows >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        if len(self.pending) == 1:
+            columns = self.pending[0]
+        else:
+            columns = [np.concatenate(parts) for parts in zip(*self.pending)]
+        self.pending = []
+        self.pending_rows = 0
+        logging.info(f'Inserting {len(columns[0])} rows')
+        self.inserted_rows += self.client.execute(self.query, columns, columnar=True)
+
+    def close(self):
+        self.client.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
@@ -1,17 +1,18 @@
 import argparse
-import glob
 import logging
-import os
+from contextlib import ExitStack
 from subprocess import PIPE
+from typing import Callable, List
 
 import numpy as np
-from astropy.io import fits
 
-from put_cat_to_ch.arg_sub_parser import ArgSubParser
+from put_cat_to_ch.arg_sub_parser import ArgSubParser, add_insert_method_arguments
+from put_cat_to_ch.ch_client import NativeInserter
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.des import sh, sql
+from put_cat_to_ch.fits_table import fits_table_dtype, insert_fits_tables
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import np_dtype_to_ch, dtype_to_le
+from put_cat_to_ch.utils import data_files, np_dtype_to_ch, dtype_to_le
 
 
 DEFAULT_DES_DR = 2
@@ -21,15 +22,20 @@ class DESPutter(CHPutter):
     """
     db = 'des'
 
-    def __init__(self, dir, user, host, clickhouse_settings, on_exists, dr, **_kwargs):
+    def __init__(self, dir, user, host, clickhouse_settings, on_exists, jobs, dr, insert_method, insert_streams,
+                 block_size, compression, **_kwargs):
         self.data_dir = dir
         self.on_exists = on_exists
+        self.processes = jobs
         self.dr = dr
+        self.insert_method = insert_method
+        self.n_insert_streams = insert_streams
+        self.block_size = block_size
+        self.compression = compression
         self.user = user
         self.host = host
         self.settings = clickhouse_settings
-        super().__init__(
-            sql,
+        self.client_kwargs = dict(
             host=self.host,
             database=self.db,
             user=self.user,
@@ -38,17 +44,22 @@ class DESPutter(CHPutter):
             send_receive_timeout=86400,
             sync_request_timeout=86400,
         )
+        super().__init__(sql, **self.client_kwargs)
         self.shell_runner = ShellRunner(sh)
 
-        self.fits_glob_pattern = os.path.join(dir, f'**/*_dr{self.dr}_main.fits')
-        self.fits_dtype = self._get_fits_data_dtype(self.fits_glob_pattern)
+        self.fits_glob_pattern = f'**/*_dr{self.dr}_main.fits'
+        self.fits_dtype = self._get_fits_data_dtype(self.fits_paths()[0])
         self.le_dtype = dtype_to_le(self.fits_dtype)
 
+    def fits_paths(self):
+        paths = data_files(self.data_dir, self.fits_glob_pattern, recursive=True)
+        if len(paths) == 0:
+            raise ValueError(f'No fits files found by pattern {self.fits_glob_pattern} in {self.data_dir}')
+        return paths
+
     @staticmethod
-    def _get_fits_data_dtype(glob_pattern):
-        path = next(glob.iglob(glob_pattern, recursive=True))
-        data = fits.getdata(path, memmap=False)
-        return data.dtype
+    def _get_fits_data_dtype(path):
+        return fits_table_dtype(path)
 
     @property
     def table_name(self):
@@ -73,29 +84,28 @@ class DESPutter(CHPutter):
             columns=self.ch_columns_str,
         )
 
-    def insert_fits_file(self, proc, path) -> int:
-        logging.info(f'Inserting {path}')
-        data = fits.getdata(path, memmap=False)
-        data = np.asarray(data, dtype=self.le_dtype)
-        proc.stdin.write(data)
-        return data.shape[0]
+    def fits_columns(self, data):
+        """Column arrays of little-endian FITS data in the order of ch_columns"""
+        return [data[name] for name in self.le_dtype.names]
+
+    def insert_streams(self, stack: ExitStack) -> List[Callable[[np.ndarray], object]]:
+        """Concurrent insert streams, their connections and processes are closed by stack"""
+        table = f'{self.db}.{self.table_name}'
+        if self.insert_method == 'native':
+            inserters = [stack.enter_context(NativeInserter(table, list(self.ch_columns), block_size=self.block_size,
+                                                            compression=self.compression, **self.client_kwargs))
+                         for _ in range(self.n_insert_streams)]
+            return [lambda data, inserter=inserter: inserter.add(self.fits_columns(data)) for inserter in inserters]
+        procs = [stack.enter_context(self.shell_runner.popen('insert.sh', table, self.host, stdin=PIPE, text=False))
+                 for _ in range(self.n_insert_streams)]
+        return [proc.stdin.write for proc in procs]
 
     def insert_data(self):
         logging.info('Collecting FITS paths')
-        paths = sorted(glob.glob(self.fits_glob_pattern, recursive=True))
-        if len(paths) == 0:
-            raise ValueError(f'No fits files found by pattern {self.fits_glob_pattern}')
-        # multiprocessing is tricky here, multithreading wouldn't help much
-        n_rows = 0
-        with self.shell_runner.popen(
-                'insert.sh',
-                f'{self.db}.{self.table_name}',
-                self.host,
-                stdin=PIPE,
-                text=False,
-        ) as proc:
-            for path in paths:
-                n_rows += self.insert_fits_file(proc, path)
+        paths = self.fits_paths()
+        with ExitStack() as stack:
+            streams = self.insert_streams(stack)
+            n_rows = insert_fits_tables(paths, self.le_dtype, streams, jobs=self.processes)
         logging.info(f'Inserted {n_rows} rows')
 
     default_actions = ('create', 'insert',)
@@ -116,5 +126,8 @@ class DESArgSubParser(ArgSubParser):
     @classmethod
     def add_arguments_to_parser(cls, parser: argparse.ArgumentParser):
         super().add_arguments_to_parser(parser)
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of processes reading FITS files for "insert" action')
         parser.add_argument('--dr', type=int, default=DEFAULT_DES_DR,
                             help='DES DR number')
+        add_insert_method_arguments(parser)
@@ -0,0 +1,191 @@
+import gzip
+import logging
+import mmap
+import multiprocessing
+from functools import partial
+from multiprocessing import Pool
+from queue import Queue
+from threading import Event, Thread
+from typing import Callable, Iterator, List, Sequence
+
+import numpy as np
+from astropy.io import fits
+
+
+__all__ = ('fits_table_dtype', 'iter_fits_table', 'insert_fits_tables',)
+
+
+# Size of the buffer for converted rows, bytes
+DEFAULT_CHUNK_SIZE = 1 << 26
+
+_MADV_DONTNEED = getattr(mmap, 'MADV_DONTNEED', None)
+
+
+def _header_dtype(hdu: fits.BinTableHDU) -> np.dtype:
+    # Column definitions are parsed from the header, FITS data are big-endian
+    return np.dtype([(name, dtype.newbyteorder('>')) for name, (dtype, _offset) in hdu.columns.dtype.fields.items()])
+
+
+def fits_table_dtype(path: str) -> np.dtype:
+    """On-disk dtype of the FITS binary table in the first extension, only the header is read"""
+    with fits.open(path, memmap=True) as hdul:
+        return _header_dtype(hdul[1])
+
+
+def iter_fits_table(path: str, dtype: np.dtype, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    """Yield rows of the FITS binary table in the first extension converted to `dtype`
+
+    Table is memory mapped, gzipped files are decompressed sequentially.
+    Rows are converted by chunks of `chunk_size` bytes into the same buffer,
+    so memory usage doesn't depend on the file size and a yielded array is
+    valid until the next one is requested.
+    """
+    logging.info(f'Reading {path}')
+    with fits.open(path, memmap=True) as hdul:
+        hdu = hdul[1]
+        raw_dtype = _header_dtype(hdu)
+        n_rows = hdu.header['NAXIS2']
+        if hdu.header['NAXIS1'] != raw_dtype.itemsize or hdu.header.get('PCOUNT', 0) != 0:
+            raise ValueError(f'{path} has a table with variable-length arrays or unsupported column layout')
+        offset = hdul.fileinfo(1)['datLoc']
+    chunk_rows = max(1, chunk_size // raw_dtype.itemsize)
+    buffer = np.empty(min(chunk_rows, n_rows), dtype=dtype)
+    if path.endswith('.gz'):
+        raw_buffer = np.empty_like(buffer, dtype=raw_dtype)
+        with gzip.open(path, 'rb') as fh:
+            fh.seek(offset)
+            for start in range(0, n_rows, chunk_rows):
+                raw = raw_buffer[:min(chunk_rows, n_rows - start)]
+                if fh.readinto(memoryview(raw).cast('B')) != raw.nbytes:
+                    raise EOFError(f'{path} is truncated')
+                chunk = buffer[:len(raw)]
+                chunk[...] = raw
+                yield chunk
+        return
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        table = np.frombuffer(mm, dtype=raw_dtype, count=n_rows, offset=offset)
+        released = 0
+        try:
+            for start in range(0, n_rows, chunk_rows):
+                raw = table[start:start + chunk_rows]
+                chunk = buffer[:len(raw)]
+                chunk[...] = raw
+                del raw
+                yield chunk
+                # Converted pages are file-backed, but they count in RSS until they are dropped
+                end = (offset + (start + len(chunk)) * raw_dtype.itemsize) // mmap.PAGESIZE * mmap.PAGESIZE
+                if _MADV_DONTNEED is not None and end > released:
+                    mm.madvise(_MADV_DONTNEED, released, end - released)
+                    released = end
+        finally:
+            # mmap cannot be closed while arrays refer to it
+            del table
+
+
+_output = None
+
+
+def _set_output(queue: multiprocessing.Queue):
+    global _output
+    _output = queue
+
+
+def _read_to_output(path: str, dtype: np.dtype, chunk_size: int):
+    """Put chunks of converted rows to the output queue as bytes, then the number of rows or an exception"""
+    try:
+        n_rows = 0
+        for chunk in iter_fits_table(path, dtype, chunk_size):
+            # Pickle it now, the buffer is going to be reused
+            _output.put(chunk.tobytes())
+            n_rows += len(chunk)
+        _output.put(n_rows)
+    except Exception as e:
+        _output.put(e)
+
+
+def insert_fits_tables(paths: Sequence[str], dtype: np.dtype, streams: List[Callable[[np.ndarray], object]],
+                       jobs: int = 1, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Read FITS tables in `jobs` processes and insert them into concurrent streams
+
+    Every stream is a callable getting little-endian record arrays, it runs
+    in its own thread, so it should use its own connection or client
+    process, and it shouldn't keep references to the arrays after it
+    returns. Tables are read by `iter_fits_table` in chunks which are
+    passed from the worker processes as bytes, the number of chunks waiting
+    for insertion is bounded to keep memory usage limited. Returns the
+    number of rows.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        FITS file paths, gzipped files are decompressed by the workers
+    dtype : numpy.dtype
+        Little-endian dtype of the tables
+    streams : list of callable
+        Insert streams
+    jobs : int
+        Number of worker processes, data are read by the main process if
+        it is 1
+    chunk_size : int
+        Size of a chunk of rows in bytes
+    """
+    queue = Queue(maxsize=len(streams))
+    errors = []
+    failed = Event()
+
+    def consume(stream):
+        while True:
+            data = queue.get()
+            if data is None:
+                return
+            # Drain the queue after a failure so the producer isn't blocked
+            if failed.is_set():
+                continue
+            try:
+                stream(data)
+            except BaseException as e:
+                errors.append(e)
+                failed.set()
+
+    threads = [Thread(target=consume, args=(stream,), daemon=True) for stream in streams]
+    for thread in threads:
+        thread.start()
+
+    n_rows = 0
+    try:
+        if jobs > 1:
+            output = multiprocessing.Queue(maxsize=jobs + len(streams))
+            with Pool(processes=jobs, initializer=_set_output, initargs=(output,)) as pool:
+                pool.map_async(partial(_read_to_output, dtype=dtype, chunk_size=chunk_size), paths, chunksize=1)
+                n_files = 0
+                while n_files < len(paths) and not failed.is_set():
+                    item = output.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if isinstance(item, int):
+                        n_files += 1
+                        continue
+                    data = np.frombuffer(item, dtype=dtype)
+                    queue.put(data)
+                    n_rows += data.shape[0]
+        else:
+            for path in paths:
+                if failed.is_set():
+                    break
+                for chunk in iter_fits_table(path, dtype, chunk_size):
+                    if failed.is_set():
+                        break
+                    # Streams run in other threads while the buffer is reused
+                    queue.put(chunk.copy())
+                    n_rows += chunk.shape[0]
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return n_rows
@@ -3,27 +3,34 @@ from __future__ import annotations
 import argparse
 import logging
 import os
+import tempfile
 from functools import cached_property
-from glob import glob
 from multiprocessing.pool import ThreadPool
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import astropy.io.ascii
 import astropy.table
 from download_cats.gaia_dr import CURRENT_DR as CURRENT_GAIA_DR
+from download_cats.utils import download_file_stats
 
 from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.gaia_dr import sh, sql
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import np_dtype_to_ch
+from put_cat_to_ch.stream import StreamInserter, remote_tasks, stream_insert
+from put_cat_to_ch.utils import data_files, np_dtype_to_ch
 
 __all__ = ('GaiaDrPutter', 'GaiaDrArgSubParser',)
 
 
 class GaiaDrPutter(CHPutter):
-    def __init__(self, dir, user, host, clickhouse_settings, on_exists, jobs, dr, **_kwargs):
+    input_pattern = 'GaiaSource*.csv.gz'
+
+    def __init__(self, dir, tmp_dir, user, host, clickhouse_settings, on_exists, jobs, dr, download_args,
+                 **_kwargs):
         self.data_dir = dir
+        self.spool_dir = tmp_dir or self.data_dir
+        self.download_args = download_args
         self.processes = jobs
         self.on_exists = on_exists
         self.user = user
@@ -32,8 +39,7 @@ class GaiaDrPutter(CHPutter):
         self.dr = dr
         self.db = f'gaia_{self.dr}'
         self.table_name = 'gaia_source'
-        super().__init__(
-            sql,
+        self.client_kwargs = dict(
             host=self.host,
             database=self.db,
             user=self.user,
@@ -42,19 +48,38 @@ class GaiaDrPutter(CHPutter):
             send_receive_timeout=86400,
             sync_request_timeout=86400,
         )
+        super().__init__(sql, **self.client_kwargs)
         self.shell_runner = ShellRunner(sh)
 
     @cached_property
     def input_files(self) -> List[str]:
-        files = sorted(glob(os.path.join(self.data_dir, 'GaiaSource*.csv.gz')))
+        files = data_files(self.data_dir, self.input_pattern)
         assert len(files) > 0, f'No files found in {self.data_dir}'
         return files
 
+    @cached_property
+    def remote_tasks(self) -> List[Tuple]:
+        return remote_tasks('gaia', self.download_args, self.spool_dir, catalog_args=['--dr', self.dr],
+                            pattern=self.input_pattern)
+
+    @staticmethod
+    def read_table(path: str) -> astropy.table.Table:
+        logging.info(f'Getting columns from {path}')
+        return astropy.io.ascii.read(path, format='ecsv', fill_values=('null', '0'))
+
     @cached_property
     def first_table(self) -> astropy.table.Table:
-        first_file = self.input_files[0]
-        logging.info(f'Getting columns from {first_file}')
-        return astropy.io.ascii.read(first_file, format='ecsv', fill_values=('null', '0'))
+        if files := data_files(self.data_dir, self.input_pattern):
+            return self.read_table(files[0])
+        # Nothing is downloaded when data is streamed, so get a single file for the table schema and remove it,
+        # it mustn't be found by "insert" action later
+        url, path, checksum = self.remote_tasks[0]
+        logging.info(f'No local files found in {self.data_dir}, downloading {url}')
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.spool_dir, prefix='.schema_') as tmp:
+            path = os.path.join(tmp, os.path.basename(path))
+            download_file_stats(url, path, checksum)
+            return self.read_table(path)
 
     @property
     def ch_columns(self) -> Dict[str, str]:
@@ -84,6 +109,11 @@ class GaiaDrPutter(CHPutter):
         with ThreadPool(processes=self.processes) as pool:
             pool.map(self.insert_single_file, self.input_files)
 
+    def stream(self):
+        inserter = StreamInserter(self.shell_runner, 'insert.sh', lambda file, table: (file, table, self.host),
+                                  f'{self.db}.{self.table_name}', self.client_kwargs, self.spool_dir)
+        stream_insert(self.remote_tasks, inserter, jobs=self.processes)
+
     default_actions = ('create', 'insert')
 
     def action_create(self):
@@ -94,6 +124,10 @@ class GaiaDrPutter(CHPutter):
         logging.info('Inserting row binary files')
         self.insert()
 
+    def action_stream(self):
+        logging.info('Streaming files from the archive into ClickHouse')
+        self.stream()
+
 
 class GaiaDrArgSubParser(ArgSubParser):
     command = 'gaia'
@@ -104,4 +138,8 @@ class GaiaDrArgSubParser(ArgSubParser):
         super().add_arguments_to_parser(parser)
         parser.add_argument('--dr', default=CURRENT_GAIA_DR, help='Gaia ZTF DR like "dr3" or "edr3"')
         parser.add_argument('-j', '--jobs', type=int, default=1,
-                            help='number of jobs "insert" actions')
+                            help='number of jobs "insert" and "stream" actions')
+        parser.add_argument('--download-args', default='',
+                            help='download_cats options for "stream" action, e.g. --download-args="--chunk-size 8", '
+                                 '"stream" downloads files and inserts them without saving to disk, it is an '
+                                 'alternative to "insert" action')
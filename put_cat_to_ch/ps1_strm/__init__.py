@@ -2,11 +2,9 @@ from __future__ import annotations
 
 import argparse
 import logging
-import os
 from functools import cached_property
-from glob import glob
 from multiprocessing.pool import ThreadPool
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import astropy.io.ascii
 import astropy.table
@@ -15,7 +13,8 @@ from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.ps1_strm import sh, sql
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import np_dtype_to_ch
+from put_cat_to_ch.stream import StreamInserter, remote_tasks, stream_insert
+from put_cat_to_ch.utils import data_files, np_dtype_to_ch
 
 __all__ = ('Ps1StrmPutter', 'Ps1StrmArgSubParser',)
 
@@ -42,16 +41,19 @@ class Ps1StrmPutter(CHPutter):
     # Put to the same DB as the main PS1 tables
     db = 'ps1'
 
-    def __init__(self, dir, user, host, clickhouse_settings, on_exists, jobs, **_kwargs):
+    input_pattern = 'hlsp_ps1-strm_ps1_gpc1*.csv.gz'
+
+    def __init__(self, dir, tmp_dir, user, host, clickhouse_settings, on_exists, jobs, download_args, **_kwargs):
         self.data_dir = dir
+        self.spool_dir = tmp_dir or self.data_dir
+        self.download_args = download_args
         self.processes = jobs
         self.on_exists = on_exists
         self.user = user
         self.host = host
         self.settings = clickhouse_settings
         self.table_name = 'strm'
-        super().__init__(
-            sql,
+        self.client_kwargs = dict(
             host=self.host,
             database=self.db,
             user=self.user,
@@ -60,14 +62,19 @@ class Ps1StrmPutter(CHPutter):
             send_receive_timeout=86400,
             sync_request_timeout=86400,
         )
+        super().__init__(sql, **self.client_kwargs)
         self.shell_runner = ShellRunner(sh)
 
     @cached_property
     def input_files(self) -> List[str]:
-        files = sorted(glob(os.path.join(self.data_dir, 'hlsp_ps1-strm_ps1_gpc1*.csv.gz')))
+        files = data_files(self.data_dir, self.input_pattern)
         assert len(files) > 0, f'No files found in {self.data_dir}'
         return files
 
+    @cached_property
+    def remote_tasks(self) -> List[Tuple]:
+        return remote_tasks('ps1-strm', self.download_args, self.spool_dir, pattern=self.input_pattern)
+
     # Original readme specified int type for cellDistance_Class while it should be float
     @cached_property
     def ch_columns(self) -> Dict[str, str]:
@@ -117,6 +124,11 @@ class Ps1StrmPutter(CHPutter):
         with ThreadPool(processes=self.processes) as pool:
             pool.map(self.insert_single_file, self.input_files)
 
+    def stream(self):
+        inserter = StreamInserter(self.shell_runner, 'insert.sh', lambda file, table: (file, table, self.host),
+                                  f'{self.db}.{self.table_name}', self.client_kwargs, self.spool_dir)
+        stream_insert(self.remote_tasks, inserter, jobs=self.processes)
+
     default_actions = ('create', 'insert')
 
     def action_create(self):
@@ -127,6 +139,10 @@ class Ps1StrmPutter(CHPutter):
         logging.info('Inserting CSV files')
         self.insert()
 
+    def action_stream(self):
+        logging.info('Streaming CSV files from the archive into ClickHouse')
+        self.stream()
+
 
 class Ps1StrmArgSubParser(ArgSubParser):
     command = 'ps1-strm'
@@ -136,4 +152,8 @@ class Ps1StrmArgSubParser(ArgSubParser):
     def add_arguments_to_parser(cls, parser: argparse.ArgumentParser):
         super().add_arguments_to_parser(parser)
         parser.add_argument('-j', '--jobs', type=int, default=1,
-                            help='number of jobs "insert" actions')
+                            help='number of jobs "insert" and "stream" actions')
+        parser.add_argument('--download-args', default='',
+                            help='download_cats options for "stream" action, e.g. --download-args="--chunk-size 8", '
+                                 '"stream" downloads files and inserts them without saving to disk, it is an '
+                                 'alternative to "insert" action')
@@ -1,18 +1,19 @@
 import argparse
-import glob
 import logging
-import os
+from contextlib import ExitStack
 from itertools import chain
 from subprocess import PIPE
+from typing import Callable, List
 
 import numpy as np
-from astropy.io import fits
 
-from put_cat_to_ch.arg_sub_parser import ArgSubParser
+from put_cat_to_ch.arg_sub_parser import ArgSubParser, add_insert_method_arguments
+from put_cat_to_ch.ch_client import NativeInserter
+from put_cat_to_ch.fits_table import fits_table_dtype, insert_fits_tables
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.sdss import sh, sql
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import np_dtype_to_ch, dtype_to_le
+from put_cat_to_ch.utils import data_files, np_dtype_to_ch, dtype_to_le
 
 DEFAULT_SDSS_DR = 16
 
@@ -30,6 +31,15 @@ def np_dtype_field_to_ch(name, dtype):
     return [(ch_name, ch_type)]
 
 
+def np_field_to_columns(data, name):
+    """Column arrays of a record array field, per-filter sub-arrays are split like in np_dtype_field_to_ch"""
+    column = data[name]
+    if column.ndim > 1:
+        assert column.shape[1:] == (len(SDSS_FILTERS),)
+        return [column[:, i] for i in range(len(SDSS_FILTERS))]
+    return [column]
+
+
 class SDSSPutter(CHPutter):
     """Put SDSS photoObj table to clickhouse
 
@@ -40,19 +50,23 @@ class SDSSPutter(CHPutter):
     """
     db = 'sdss'
 
-    def __init__(self, dir, user, host, clickhouse_settings, on_exists, jobs, dr, **_kwargs):
+    def __init__(self, dir, user, host, clickhouse_settings, on_exists, jobs, dr, insert_method, insert_streams,
+                 block_size, compression, **_kwargs):
         self.data_dir = dir
-        self.fits_glob_pattern = os.path.join(dir, '**/calibObj-*-star.fits.gz')
-        self.fits_dtype = self._get_fits_data_dtype(self.fits_glob_pattern)
+        self.fits_glob_pattern = '**/calibObj-*-star.fits.gz'
+        self.fits_dtype = self._get_fits_data_dtype(self.fits_paths()[0])
         self.le_dtype = dtype_to_le(self.fits_dtype)
         self.processes = jobs
         self.on_exists = on_exists
         self.dr = dr
+        self.insert_method = insert_method
+        self.n_insert_streams = insert_streams
+        self.block_size = block_size
+        self.compression = compression
         self.user = user
         self.host = host
         self.settings = clickhouse_settings
-        super().__init__(
-            sql,
+        self.client_kwargs = dict(
             host=self.host,
             database=self.db,
             user=self.user,
@@ -61,13 +75,18 @@ class SDSSPutter(CHPutter):
             send_receive_timeout=86400,
             sync_request_timeout=86400,
         )
+        super().__init__(sql, **self.client_kwargs)
         self.shell_runner = ShellRunner(sh)
 
+    def fits_paths(self):
+        paths = data_files(self.data_dir, self.fits_glob_pattern, recursive=True)
+        if len(paths) == 0:
+            raise ValueError(f'No fits files found by pattern {self.fits_glob_pattern} in {self.data_dir}')
+        return paths
+
     @staticmethod
-    def _get_fits_data_dtype(glob_pattern):
-        path = next(glob.iglob(glob_pattern, recursive=True))
-        data = fits.getdata(path, memmap=False)
-        return data.dtype
+    def _get_fits_data_dtype(path):
+        return fits_table_dtype(path)
 
     @property
     def table_name(self):
@@ -92,25 +111,31 @@ class SDSSPutter(CHPutter):
             columns=self.ch_columns_str,
         )
 
-    def insert_fits(self, path, proc):
-        logging.info(f'Inserting {path}')
-        data = fits.getdata(path, memmap=False)
-        data = np.asarray(data, dtype=self.le_dtype)
-        proc.stdin.write(data)
+    def fits_columns(self, data):
+        """Column arrays of little-endian FITS data in the order of ch_columns"""
+        return list(chain.from_iterable(np_field_to_columns(data, name) for name in self.le_dtype.names))
+
+    def insert_streams(self, stack: ExitStack) -> List[Callable[[np.ndarray], object]]:
+        """Concurrent insert streams, their connections and processes are closed by stack"""
+        table = f'{self.db}.{self.table_name}'
+        if self.insert_method == 'native':
+            inserters = [stack.enter_context(NativeInserter(table, list(self.ch_columns), block_size=self.block_size,
+                                                            compression=self.compression, **self.client_kwargs))
+                         for _ in range(self.n_insert_streams)]
+            return [lambda data, inserter=inserter: inserter.add(self.fits_columns(data)) for inserter in inserters]
+        logging.info('Starting shell insert scripts')
+        procs = [stack.enter_context(self.shell_runner.popen('insert.sh', table, self.host, stdin=PIPE, text=False))
+                 for _ in range(self.n_insert_streams)]
+        return [proc.stdin.write for proc in procs]
 
     def insert_data(self):
         logging.info('Collecting FITS paths')
-        paths = sorted(glob.iglob(self.fits_glob_pattern, recursive=True))
-        logging.info('Starting shell insert script')
-        with self.shell_runner.popen(
-                'insert.sh',
-                f'{self.db}.{self.table_name}',
-                self.host,
-                stdin=PIPE,
-                text=False,
-        ) as proc:
-            for path in paths:
-                self.insert_fits(path, proc)
+        paths = self.fits_paths()
+        # calibObj files are gzipped, they are decompressed by the reading processes
+        with ExitStack() as stack:
+            streams = self.insert_streams(stack)
+            n_rows = insert_fits_tables(paths, self.le_dtype, streams, jobs=self.processes)
+        logging.info(f'Inserted {n_rows} rows')
 
     default_actions = ('create', 'insert',)
 
@@ -131,6 +156,7 @@ class SDSSArgSubParser(ArgSubParser):
     def add_arguments_to_parser(cls, parser: argparse.ArgumentParser):
         super().add_arguments_to_parser(parser)
         parser.add_argument('-j', '--jobs', type=int, default=1,
-                            help='number of jobs for "insert" action')
+                            help='number of processes reading FITS files for "insert" action')
         parser.add_argument('--dr', type=int, default=DEFAULT_SDSS_DR,
                             help='SDSS DR number')
+        add_insert_method_arguments(parser)
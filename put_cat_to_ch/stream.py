@@ -0,0 +1,232 @@
+import logging
+import os
+import re
+import shlex
+import signal
+import threading
+from fnmatch import fnmatch
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from subprocess import PIPE, CalledProcessError
+from time import perf_counter
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+from clickhouse_driver import Client
+from download_cats import FETCHERS
+from download_cats.__main__ import parse_args as parse_download_args
+from download_cats.stats import FileStats
+from download_cats.utils import (RETRIABLE_ERRORS, DownloadFailed, FileDownloader, GzipValidator,
+                                 HashSumCheckFailed, configure_downloader, download_file_stats, get_report,
+                                 new_session, shard_tasks)
+
+from put_cat_to_ch.shell_runner import ShellRunner
+
+
+__all__ = ('remote_tasks', 'StreamInserter', 'stream_insert',)
+
+
+def remote_tasks(catalog: str, download_args: str, spool_dir: str, catalog_args: Sequence[str] = (),
+                 pattern: str = '*') -> List[Tuple]:
+    """Download tasks of a download_cats catalog which file names match glob pattern
+
+    download_cats is configured by `download_args` command line arguments,
+    task paths are in `spool_dir`. --shard selects files like it does for
+    download_cats, options which make sense for files on disk only are
+    rejected
+    """
+    cli_args = parse_download_args([*shlex.split(download_args), '-d', spool_dir, catalog, *catalog_args])
+    unsupported = [option for option, value in (('--sync', cli_args.sync), ('--plan', cli_args.plan),
+                                                ('--mirror', cli_args.mirror), ('--stripe-dir', cli_args.stripe_dir))
+                   if value]
+    if unsupported:
+        raise ValueError(f'download_cats options {", ".join(unsupported)} are not supported for streaming')
+    configure_downloader(cli_args)
+    fetcher = FETCHERS[catalog](cli_args)
+    tasks = [task for task in fetcher.tasks() if fnmatch(os.path.basename(task[1]), pattern)]
+    if cli_args.shard is not None:
+        tasks = shard_tasks(tasks, *cli_args.shard)
+    return tasks
+
+
+class StreamInserter:
+    """Insert remote files into ClickHouse while they are being downloaded
+
+    HTTP body of a file is piped to the stdin of an insert shell script,
+    which is called with "-" as the file path.
+    md5 checksum is computed on the fly, gzip files without checksums are
+    validated by `GzipValidator`. If the transfer fails or the file is
+    corrupted, the script is killed together with its children. Then the
+    file is downloaded to `spool_dir` by download_cats, which resumes
+    partial transfers and verifies the file, inserted from there and
+    removed.
+
+    A file takes a lot of insert blocks, ClickHouse commits every block
+    and doesn't roll them back when the stream fails. So every file is
+    inserted into its own empty staging table with the structure of the
+    target table, its partitions are attached to the target table when the
+    file is verified and inserted completely, and the staging table is
+    dropped. A failed stream leaves nothing in the target table.
+
+    Arguments
+    ---------
+    shell_runner : ShellRunner
+        Runner of the putter shell scripts
+    script : str
+        Insert script, "-" file path must mean stdin
+    script_args : callable
+        Function of file path and table name returning arguments of the
+        insert script
+    table : str
+        Target table including database
+    client_kwargs : dict
+        clickhouse_driver.Client keyword arguments, used to manage staging
+        tables
+    spool_dir : str
+        Directory for files which failed to stream
+    chunk_size : int or None
+        Size of chunks read from HTTP response, default is download_cats
+        --chunk-size
+    retries : int
+        Number of download attempts of a spooled file
+    """
+
+    def __init__(self, shell_runner: ShellRunner, script: str, script_args: Callable[[str, str], Sequence[str]],
+                 table: str, client_kwargs: dict, spool_dir: str,
+                 chunk_size: Optional[int] = None, retries: int = 3):
+        self.shell_runner = shell_runner
+        self.script = script
+        self.script_args = script_args
+        self.table = table
+        self.client_kwargs = client_kwargs
+        self.spool_dir = spool_dir
+        self.chunk_size = FileDownloader.chunk_size if chunk_size is None else chunk_size
+        self.retries = retries
+        self.session = None
+        self._local = threading.local()
+
+    @property
+    def client(self) -> Client:
+        # clickhouse_driver.Client is not thread-safe
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client(**self.client_kwargs)
+        return self._local.client
+
+    def staging_table(self, path: str) -> str:
+        suffix = re.sub(r'\W', '_', os.path.basename(path))
+        return f'{self.table}_stream_{suffix}'
+
+    def create_staging_table(self, staging: str):
+        # Leftover of an interrupted run
+        self.client.execute(f'DROP TABLE IF EXISTS {staging}')
+        self.client.execute(f'CREATE TABLE {staging} AS {self.table}')
+
+    def attach_staging_table(self, staging: str):
+        database, table = staging.split('.', maxsplit=1)
+        partitions = self.client.execute(
+            'SELECT DISTINCT partition_id FROM system.parts WHERE database = %(database)s AND table = %(table)s '
+            'AND active',
+            {'database': database, 'table': table},
+        )
+        for partition_id, in partitions:
+            self.client.execute(f"ALTER TABLE {self.table} ATTACH PARTITION ID '{partition_id}' FROM {staging}")
+
+    def stream(self, url: str, path: str, checksum: Optional[str], staging: str) -> FileStats:
+        stats = FileStats(url=url, path=path, attempts=1)
+        validator = GzipValidator() if checksum is None and url.endswith('.gz') else None
+        hash = md5()
+        # New session lets killing the whole pipeline, not only the shell
+        proc = self.shell_runner.popen(self.script, *self.script_args('-', staging), stdin=PIPE,
+                                       start_new_session=True)
+        start = perf_counter()
+        complete = False
+        try:
+            with self.session.get(url, stream=True) as resp:
+                resp.raise_for_status()
+                stats.ttfb = perf_counter() - start
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    hash_start = perf_counter()
+                    hash.update(chunk)
+                    if validator is not None:
+                        validator.update(chunk)
+                    stats.hash_time += perf_counter() - hash_start
+                    try:
+                        proc.stdin.write(chunk)
+                    except BrokenPipeError:
+                        raise CalledProcessError(proc.wait(), self.script)
+                    stats.bytes += len(chunk)
+            if checksum is not None and hash.hexdigest() != checksum:
+                raise HashSumCheckFailed(f'Checksum of streamed {url} is {hash.hexdigest()}, expected {checksum}')
+            if validator is not None:
+                validator.finish()
+            complete = True
+        finally:
+            if not complete:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+            stats.transfer_time = perf_counter() - start
+        if returncode != 0:
+            raise CalledProcessError(returncode, self.script)
+        stats.size = stats.bytes
+        stats.status = 'downloaded'
+        return stats
+
+    def spool(self, url: str, path: str, checksum: Optional[str], staging: str) -> FileStats:
+        stats = download_file_stats(url, path, checksum, session=self.session, retries=self.retries,
+                                    raise_on_failure=False)
+        if stats.status == 'failed':
+            return stats
+        logging.info(f'Inserting spooled {path}')
+        self.shell_runner(self.script, *self.script_args(path, staging))
+        os.remove(path)
+        return stats
+
+    def __call__(self, task: Tuple) -> FileStats:
+        url, path, *checksum = task
+        checksum = checksum[0] if checksum else None
+        path = os.path.join(self.spool_dir, os.path.basename(path))
+        if self.session is None:
+            self.session = new_session()
+        staging = self.staging_table(path)
+        self.create_staging_table(staging)
+        try:
+            logging.info(f'Streaming {url} into {staging}')
+            try:
+                stats = self.stream(url, path, checksum, staging)
+            except RETRIABLE_ERRORS as e:
+                logging.warning(f'Streaming {url} failed: {type(e).__name__}: {e}, downloading it to {path}')
+                # Drop blocks inserted before the failure
+                self.create_staging_table(staging)
+                stats = self.spool(url, path, checksum, staging)
+            if stats.status != 'failed':
+                logging.info(f'Attaching {staging} to {self.table}')
+                self.attach_staging_table(staging)
+        finally:
+            self.client.execute(f'DROP TABLE IF EXISTS {staging}')
+        get_report().add(stats)
+        return stats
+
+
+def stream_insert(tasks: Iterable[Tuple], inserter: StreamInserter, jobs: int = 1):
+    """Stream files of download tasks into ClickHouse with `jobs` concurrent inserts
+
+    A file which cannot be downloaded doesn't stop the others,
+    `DownloadFailed` is raised in the end if there are such files
+    """
+    tasks = list(tasks)
+    assert len(tasks) > 0, 'No files to stream'
+    os.makedirs(inserter.spool_dir, exist_ok=True)
+    inserter.session = new_session(pool_size=jobs)
+    report = get_report()
+    with ThreadPool(processes=jobs) as pool:
+        n_failed = sum(stats.status == 'failed' for stats in pool.imap_unordered(inserter, tasks))
+    report.log_summary()
+    if n_failed > 0:
+        report.log_failures()
+        raise DownloadFailed(f'{n_failed} files failed to download and they are not inserted, see the log above')
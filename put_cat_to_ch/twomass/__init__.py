@@ -1,3 +1,4 @@
+from argparse import ArgumentParser
 from typing import List, Tuple
 
 import bs4
@@ -8,6 +9,8 @@ from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.twomass import sql, sh
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.shell_runner import ShellRunner
+from put_cat_to_ch.stream import StreamInserter, remote_tasks, stream_insert
+from put_cat_to_ch.utils import data_files
 
 
 def printf_to_ch(fmt):
@@ -62,14 +65,16 @@ class TwoMASSPutter(CHPutter):
     db = 'twomass'
     psc_table = 'psc'
 
-    def __init__(self, dir, user, host, clickhouse_settings, on_exists, **_kwargs):
+    def __init__(self, dir, tmp_dir, user, host, clickhouse_settings, on_exists, jobs, download_args, **_kwargs):
         self.dir = dir
+        self.spool_dir = tmp_dir or self.dir
+        self.processes = jobs
+        self.download_args = download_args
         self.on_exists = on_exists
         self.user = user
         self.host = host
         self.settings = clickhouse_settings
-        super().__init__(
-            sql,
+        self.client_kwargs = dict(
             host=self.host,
             database=self.db,
             user=self.user,
@@ -78,6 +83,7 @@ class TwoMASSPutter(CHPutter):
             send_receive_timeout=86400,
             sync_request_timeout=86400,
         )
+        super().__init__(sql, **self.client_kwargs)
         self.shell_runner = ShellRunner(sh)
 
     def ch_columns_str(self):
@@ -109,7 +115,14 @@ class TwoMASSPutter(CHPutter):
         assert_array_equal(actual, desired)
 
     def insert_into_pcs_table(self):
-        self.shell_runner('insert_into_psc.sh', self.dir, f'{self.db}.{self.psc_table}', self.host)
+        paths = data_files(self.dir, 'psc_*.gz')
+        self.shell_runner('insert_into_psc.sh', f'{self.db}.{self.psc_table}', self.host, *paths)
+
+    def stream_into_psc_table(self):
+        tasks = remote_tasks('2mass', self.download_args, self.spool_dir, pattern='psc_*.gz')
+        inserter = StreamInserter(self.shell_runner, 'insert_into_psc.sh', lambda file, table: (table, self.host, file),
+                                  f'{self.db}.{self.psc_table}', self.client_kwargs, self.spool_dir)
+        stream_insert(tasks, inserter, jobs=self.processes)
 
     default_actions = ('create', 'insert', 'test',)
 
@@ -119,6 +132,9 @@ class TwoMASSPutter(CHPutter):
     def action_insert(self):
         self.insert_into_pcs_table()
 
+    def action_stream(self):
+        self.stream_into_psc_table()
+
     def action_test(self):
         self.test_psc_table()
 
@@ -126,3 +142,13 @@ class TwoMASSPutter(CHPutter):
 class TwoMassArgSubParser(ArgSubParser):
     command = '2mass'
     putter_cls = TwoMASSPutter
+
+    @classmethod
+    def add_arguments_to_parser(cls, parser: ArgumentParser):
+        super().add_arguments_to_parser(parser)
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of concurrent inserts of "stream" action')
+        parser.add_argument('--download-args', default='',
+                            help='download_cats options for "stream" action, e.g. --download-args="--chunk-size 8", '
+                                 '"stream" downloads files and inserts them without saving to disk, it is an '
+                                 'alternative to "insert" action')
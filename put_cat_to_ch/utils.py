@@ -1,11 +1,16 @@
 import logging
 import os
+import re
+from functools import lru_cache
+from glob import glob
 from pathlib import Path
-from typing import Set, Union
+from typing import Dict, List, Optional, Set, Union
 
 import numpy as np
 from pyarrow.parquet import ParquetFile
 
+from download_cats.manifest import INVENTORY, PLACEMENT_MANIFEST, read_json_lines
+
 
 def subclasses(cls: type) -> Set[type]:
     return set(cls.__subclasses__()).union(subcls for c in cls.__subclasses__() for subcls in subclasses(c))
@@ -66,5 +71,114 @@ def is_parquet_file_empty(path: Union[str, Path]) -> bool:
     return pf.metadata.num_rows == 0
 
 
+@lru_cache(maxsize=None)
+def get_placement(data_dir: str) -> Dict[str, str]:
+    """Mapping of path relative to data_dir to directory where download_cats --stripe-dir put the file
+
+    Files which are not in the mapping are in data_dir itself
+    """
+    records = read_json_lines(os.path.join(data_dir, PLACEMENT_MANIFEST)) or []
+    return {record['path']: record['root'] for record in records}
+
+
+@lru_cache(maxsize=None)
+def get_inventory(data_dir: str) -> Optional[Dict[str, dict]]:
+    """Records of files written by download_cats by their paths relative to data_dir, None if there is no inventory
+
+    Records have "size", "md5" and "rows" values which are None if unknown,
+    and "root" value if the file is not in data_dir
+    """
+    records = read_json_lines(os.path.join(data_dir, INVENTORY))
+    if records is None:
+        return None
+    return {record['path']: record for record in records}
+
+
+def data_roots(data_dir: str) -> List[str]:
+    """data_dir followed by other directories which have files of data_dir placed by download_cats --stripe-dir"""
+    roots = {os.path.abspath(data_dir): data_dir}
+    for root in get_placement(data_dir).values():
+        roots.setdefault(os.path.abspath(root), root)
+    return list(roots.values())
+
+
+def placed_path(data_dir: str, path: str) -> str:
+    """Actual location of a file which would be at path inside data_dir without download_cats --stripe-dir"""
+    relpath = os.path.relpath(path, data_dir)
+    root = get_placement(data_dir).get(relpath)
+    if root is None:
+        return path
+    return os.path.join(root, relpath)
+
+
+def _glob_regex(pattern: str, recursive: bool) -> re.Pattern:
+    """Regular expression matching relative paths like glob.glob matches files"""
+    components = pattern.split('/')
+    regex = []
+    for i, component in enumerate(components):
+        last = i == len(components) - 1
+        if recursive and component == '**':
+            regex.append('.*' if last else '(?:[^/]+/)*')
+            continue
+        j = 0
+        while j < len(component):
+            c = component[j]
+            j += 1
+            if c == '*':
+                regex.append('[^/]*')
+            elif c == '?':
+                regex.append('[^/]')
+            elif c == '[' and (end := component.find(']', j + 1)) != -1:
+                chars = component[j:end]
+                if chars.startswith('!'):
+                    chars = f'^{chars[1:]}'
+                regex.append(f'[{chars}]')
+                j = end + 1
+            else:
+                regex.append(re.escape(c))
+        if not last:
+            regex.append('/')
+    return re.compile(''.join(regex))
+
+
+def data_file_map(data_dir: str, pattern: str, recursive: bool = False) -> Dict[str, str]:
+    """Mapping of relative path to path of files matching glob pattern relative to data_dir, sorted by relative path
+
+    Files are looked up in the inventory written by download_cats, data_dir
+    is scanned only if there is no inventory or no inventory file matches
+    the pattern. Scanning includes files placed to other directories by
+    download_cats --stripe-dir, stale copies which are not in the placement
+    manifest are skipped
+    """
+    inventory = get_inventory(data_dir)
+    if inventory is not None:
+        regex = _glob_regex(pattern, recursive)
+        relpaths = sorted(relpath for relpath in inventory if regex.fullmatch(relpath))
+        if relpaths:
+            return {relpath: os.path.join(inventory[relpath].get('root', data_dir), relpath) for relpath in relpaths}
+        logging.info(f'No files matching {pattern} are in the inventory of {data_dir}, scanning the directory')
+    placement = get_placement(data_dir)
+    paths = {}
+    for root in data_roots(data_dir):
+        for path in glob(os.path.join(root, pattern), recursive=recursive):
+            relpath = os.path.relpath(path, root)
+            if os.path.abspath(placement.get(relpath, data_dir)) == os.path.abspath(root):
+                paths[relpath] = path
+    return {relpath: paths[relpath] for relpath in sorted(paths)}
+
+
+def data_files(data_dir: str, pattern: str, recursive: bool = False) -> List[str]:
+    """Paths of files matching glob pattern relative to data_dir, sorted by relative path, see `data_file_map`"""
+    return list(data_file_map(data_dir, pattern, recursive=recursive).values())
+
+
+def known_rows(data_dir: str, relpath: str) -> Optional[int]:
+    """Number of rows of a file recorded in the inventory, None if it is unknown"""
+    inventory = get_inventory(data_dir)
+    if inventory is None or relpath not in inventory:
+        return None
+    return inventory[relpath]['rows']
+
+
 def dtype_to_le(dtype):
     return np.dtype([(name, dt.newbyteorder('<')) for name, (dt, _offset) in dtype.fields.items()])
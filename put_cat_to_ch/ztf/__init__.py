@@ -2,16 +2,17 @@ import argparse
 import logging
 import os
 import re
-from glob import glob
+from functools import cached_property
 from multiprocessing.pool import ThreadPool
-from typing import List, Iterable, Optional, Union
+from typing import Dict, List, Iterable, Optional, Union
 
 import numpy as np
 
 from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.putter import CHPutter
 from put_cat_to_ch.shell_runner import ShellRunner
-from put_cat_to_ch.utils import is_parquet_file_empty, remove_files_and_directory
+from put_cat_to_ch.utils import (data_file_map, data_files, is_parquet_file_empty, known_rows,
+                                 remove_files_and_directory)
 from put_cat_to_ch.ztf import sh, sql
 
 
@@ -132,20 +133,32 @@ class ZtfPutter(CHPutter):
         field_no = int(match.group(1))
         return field_no
 
+    @cached_property
+    def parquet_files_by_dir(self) -> Dict[str, Dict[str, str]]:
+        """Relative path to path mappings of .parquet files by their field directories
+
+        All files are listed at once, from download_cats inventory if it
+        exists, see `data_file_map`
+        """
+        files = {}
+        for relpath, path in data_file_map(self.data_dir, '*/field*/**/*.parquet', recursive=True).items():
+            dir = '/'.join(relpath.split('/')[:2])
+            files.setdefault(dir, {})[relpath] = path
+        return files
+
     def parquet_dirs(self) -> List[str]:
-        """Field directories, e.g. ./0/field0202"""
-        path_template = os.path.join(self.data_dir, '*/field*')
-        dir_paths = sorted(glob(path_template))
-        return dir_paths
+        """Field directories relative to the data directory, e.g. 0/field0202
+
+        Files of a field can be spread over several directories by
+        download_cats --stripe-dir, see `parquet_files_in_dir`
+        """
+        return sorted(self.parquet_files_by_dir)
 
     def parquet_files_in_dir(self, dir: str) -> List[str]:
-        path_template = os.path.join(dir, '**/*.parquet')
-        file_paths = sorted(glob(path_template, recursive=True))
-        return file_paths
+        return list(self.parquet_files_by_dir.get(dir, {}).values())
 
     def tar_gz_files(self) -> List[str]:
-        path_template = os.path.join(self.data_dir, 'field*.tar.gz')
-        file_paths = sorted(glob(path_template))
+        file_paths = data_files(self.data_dir, 'field*.tar.gz')
         return file_paths
 
     def tar_gz_to_csv(self, path: str) -> str:
@@ -264,9 +277,9 @@ class ZtfPutter(CHPutter):
 
     def insert_parquet_into_tmp_parquet_table_worker(self, dir: str):
         logging.info(f'Inserting {dir} info {self.tmp_parquet_table}')
-        paths = self.parquet_files_in_dir(dir)
-        for filepath in paths:
-            if is_parquet_file_empty(filepath):
+        for relpath, filepath in self.parquet_files_by_dir.get(dir, {}).items():
+            rows = known_rows(self.data_dir, relpath)
+            if rows == 0 or rows is None and is_parquet_file_empty(filepath):
                 logging.warning(f'Parquet file {filepath} is empty, skipping')
                 continue
             logging.info(f'Inserting {filepath} info {self.tmp_parquet_table}')
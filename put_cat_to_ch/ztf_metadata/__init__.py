@@ -11,6 +11,7 @@ from joblib import Parallel, delayed
 from put_cat_to_ch.arg_sub_parser import ArgSubParser
 from put_cat_to_ch.shell_runner import ShellRunner
 from put_cat_to_ch.putter import CHPutter
+from put_cat_to_ch.utils import placed_path
 from put_cat_to_ch.ztf_metadata import sh, sql
 
 from .fields import get_rcid_centers
@@ -46,7 +47,7 @@ class ZTFMetadataPutter(CHPutter):
         )
         self.shell_runner = ShellRunner(sh)
 
-        self.db_file = Path(self.data_dir) / 'ztf_metadata_latest.db'
+        self.db_file = Path(placed_path(self.data_dir, str(Path(self.data_dir) / 'ztf_metadata_latest.db')))
         self.tmp_exposure_file = Path(self.tmp_dir) / 'tmp_ztf_metadata.parquet'
 
     # It is easier to specify columns manually to pack some values to smaller types
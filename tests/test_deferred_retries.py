@@ -0,0 +1,59 @@
+import os
+import threading
+
+import pytest
+
+from benchmarks.server import build_tree, make_server
+from download_cats.aio import download_files_async
+from download_cats.stats import DownloadReport, FileStats
+from download_cats.utils import DeferredRetries
+
+
+def test_finished_stats_include_deferred_rounds():
+    deferred = DeferredRetries(rounds=2, delay=0.0)
+    task = ('http://example.com/a', '/tmp/a')
+    first = FileStats(*task, status='failed', bytes=100, transfer_time=1.0, hash_time=0.5, attempts=2)
+    assert deferred.defer(task, first)
+    assert deferred.pop_ready() == task
+    last = FileStats(*task, status='downloaded', bytes=50, transfer_time=0.5, hash_time=0.25, attempts=1)
+    assert not deferred.defer(task, last)
+    assert (last.attempts, last.bytes, last.transfer_time, last.hash_time) == (3, 150, 1.5, 0.75)
+    assert len(deferred.failures) == 0
+
+
+def test_given_up_stats_include_deferred_rounds():
+    deferred = DeferredRetries(rounds=1, delay=0.0)
+    task = ('http://example.com/a', '/tmp/a')
+    assert deferred.defer(task, FileStats(*task, status='failed', bytes=10, attempts=1))
+    deferred.pop_ready()
+    last = FileStats(*task, status='failed', bytes=20, attempts=1)
+    assert not deferred.defer(task, last)
+    assert (last.attempts, last.bytes) == (2, 30)
+
+
+@pytest.fixture
+def flaky_server():
+    tree = build_tree('gaia', n_files=8, mean_size=1 << 18, seed=1)
+    server = make_server(tree, truncate_rate=0.5, seed=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield f'http://{host}:{port}', tree
+    server.shutdown()
+    server.server_close()
+
+
+def test_report_counts_deferred_retries(tmp_path, flaky_server):
+    base_url, tree = flaky_server
+    files = {path: f for path, f in tree.items() if path.endswith('.csv.gz')}
+    tasks = [(f'{base_url}{path}', os.path.join(tmp_path, os.path.basename(path))) for path in files]
+    report = DownloadReport()
+    deferred = DeferredRetries(rounds=20, delay=0.0)
+    download_files_async(tasks, connections=4, per_host=4, report=report, deferred=deferred)
+
+    assert report.counts() == {'downloaded': len(tasks)}
+    assert deferred.counter > 0
+    summary = report.summary()
+    assert summary['retries'] >= deferred.counter
+    # Truncated transfers are resumed, so every byte is transferred exactly once
+    assert summary['bytes'] == sum(f.size for f in files.values())